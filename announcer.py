@@ -0,0 +1,125 @@
+from tornado.ioloop import IOLoop
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class Announcer:
+    """Windowed chat announcements of users entering, leaving and following.
+
+    Users announced within the same window are grouped into one message,
+    such as "Welcome, @a, @b and 37 others!", which fits in a single chat
+    message. A user who follows again within the follow cooldown, after
+    toggling follow and unfollow, is only thanked once.
+    """
+
+    templates = OrderedDict((
+        ("enter", "Welcome, {}!"),
+        ("leave", "See you, {}!"),
+        ("follow", "Thanks for the follow, {}!"),
+        ("subscribe", "Thanks for the subscription, {}! <3")
+    ))
+
+    def __init__(self, send, max_length=360, config=None):
+        self.send = send
+        self.max_length = max_length
+
+        self.pending = OrderedDict((kind, OrderedDict())
+                                   for kind in self.templates)
+        self.followed = OrderedDict()
+        self.scheduled = False
+
+        self.announced = 0
+        self.grouped = 0
+        self.suppressed = 0
+
+        self.configure(config or dict())
+
+    def configure(self, config):
+        """Apply the announcements configuration."""
+
+        self.enabled = {
+            "enter": config.get("announce_enter", False),
+            "leave": config.get("announce_leave", False),
+            "follow": config.get("announce_follow", True),
+            "subscribe": config.get("announce_subscribe", True)
+        }
+        self.window = config.get("window", 5)
+        self.follow_cooldown = config.get("follow_cooldown", 3600)
+
+    def announce(self, kind, username):
+        """Queue an announcement of a user, to be sent with the window."""
+
+        if not self.enabled[kind]:
+            return
+
+        if kind == "follow" and not self._first_follow(username):
+            self.suppressed += 1
+            return
+
+        users = self.pending[kind]
+        if username in users:
+            self.suppressed += 1
+            return
+        users[username] = None
+
+        if not self.scheduled:
+            self.scheduled = True
+            IOLoop.current().call_later(self.window, self.flush)
+
+    def _first_follow(self, username):
+        now = monotonic()
+
+        while self.followed:
+            oldest, followed = next(iter(self.followed.items()))
+            if now - followed < self.follow_cooldown:
+                break
+            del self.followed[oldest]
+
+        if username in self.followed:
+            return False
+        self.followed[username] = now
+        return True
+
+    def flush(self):
+        """Send the pending announcements, one message per kind."""
+
+        self.scheduled = False
+
+        for kind, users in self.pending.items():
+            if users:
+                self.send(self.format(self.templates[kind], list(users)))
+                self.announced += len(users)
+                self.grouped += len(users) - 1
+                users.clear()
+
+    def format(self, template, usernames):
+        """Fill a template with as many users as fit in one message."""
+
+        shown = 1
+        while (shown < len(usernames) and len(self._fill(
+                template, usernames, shown + 1)) <= self.max_length):
+            shown += 1
+        return self._fill(template, usernames, shown)
+
+    @staticmethod
+    def _fill(template, usernames, shown):
+        names = ['@' + username for username in usernames[:shown]]
+        others = len(usernames) - shown
+
+        if others:
+            return template.format("{} and {} other{}".format(
+                ", ".join(names), others, 's' if others > 1 else ''))
+        if len(names) > 1:
+            return template.format("{} and {}".format(
+                ", ".join(names[:-1]), names[-1]))
+        return template.format(names[0])
+
+    def stats(self):
+        """Get announcement counts."""
+
+        return {
+            "announced": self.announced,
+            "grouped": self.grouped,
+            "suppressed": self.suppressed
+        }
@@ -1,37 +1,118 @@
-from tornado.websocket import websocket_connect
-from tornado.gen import coroutine
+from tornado.websocket import websocket_connect, WebSocketClosedError
+from tornado.gen import coroutine, sleep, with_timeout, WaitIterator
 from tornado.ioloop import PeriodicCallback
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.httputil import url_concat
 
-from requests import Session
-from requests.compat import urljoin
+from urllib.parse import urljoin, urlencode
+from http.cookies import SimpleCookie
 
 from logging import getLogger as get_logger
 from logging import getLevelName as get_level_name
-from logging import StreamHandler, FileHandler, Formatter
+from logging import StreamHandler, Formatter, DEBUG
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
+from atexit import register as register_exit
+from datetime import timedelta
 from functools import partial
-from json import dumps, loads
+from queue import Queue
+from random import uniform
+from time import monotonic
 
-from re import match
+from codec import loads, encode_method, encode_subscription
+from codec import name as codec_name
+from cache import Cache
+from outbound import MessageQueue
+from announcer import Announcer
+from metrics import rest_latency, reconnects
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler that leaves formatting to the listener's thread."""
+
+    def prepare(self, record):
+        return record
+
+
+class AuthenticationError(ConnectionError):
+    """Beam rejected a chat authentication."""
 
 
 class Beam:
     path = "https://beam.pro/api/v1/"
+    liveloading_path = (
+        "wss://realtime.beam.pro/socket.io/?EIO=3&transport=websocket")
 
     message_id = 0
+    closing = False
+
+    max_clients = 10
+    connect_timeout = 5
+    request_timeout = 10
+
+    reconnect_delay = 1
+    max_reconnect_delay = 60
+    race_width = 2
+    endpoint_cooldown = 300
+    auth_timeout = 10
+
+    liveloading_events = ("followed", "subscribed", "resubscribed")
+
+    cache_ttl = {
+        "channel": 60,
+        "chat": 30,
+        "manifest": 15,
+        "user": 3600
+    }
 
     def __init__(self, debug="INFO", **kwargs):
-        self._init_logger(debug, kwargs.get("log_to_file", True))
-        self.http_session = Session()
+        if kwargs.get("logger") is None:
+            self._init_logger(debug, kwargs.get("log_to_file", True))
+            self._init_http_client()
+            if codec_name == "json":
+                self.logger.warning(
+                    "Modules 'orjson' and 'ujson' unavailable; "
+                    "using slower JSON.")
+        else:
+            self.logger = kwargs["logger"]
+
+        self.path = kwargs.get("api") or self.path
+        self.liveloading_path = (
+            kwargs.get("liveloading") or self.liveloading_path)
+
+        self.cookies = kwargs.get("cookies")
+        if self.cookies is None:
+            self.cookies = SimpleCookie()
+
+        self.cache = kwargs.get("cache")
+        if self.cache is None:
+            self.cache = Cache(kwargs.get("cache_size", 256))
+
+        self.outbound = MessageQueue(self._write_packet)
+        self.announcer = Announcer(
+            self.send_message, self.outbound.max_length)
+
+        self.authkey = None
+        self.servers = list()
+        self.endpoint = None
+        self.failed_endpoints = dict()
+
+        self.liveloading_interfaces = tuple()
+        self.liveloading_ping = None
+        self.liveloading_lost = None
+        self.liveloading_reconnects = 0
+        self.liveloading_dead_time = 0.0
 
     def _init_logger(self, level="INFO", file_logging=True, **kwargs):
-        """Initialize logger."""
+        """Initialize logger.
+
+        Records are queued and written by a background thread, so slow
+        terminals and disks do not block the IOLoop.
+        """
 
         self.logger = get_logger("CactusBot")
         self.logger.propagate = False
 
-        self.logger.setLevel("DEBUG")
-
         if level is True or level.lower() == "true":
             level = "DEBUG"
         elif level is False or level.lower() == "false":
@@ -54,29 +135,112 @@ class Beam:
             self.logger.warning(
                 "Module 'coloredlogs' unavailable; using ugly logging.")
 
+        handlers = list()
+
         stream_handler = StreamHandler()
         stream_handler.setLevel(level)
         stream_handler.setFormatter(colored_formatter)
-        self.logger.addHandler(stream_handler)
+        handlers.append(stream_handler)
 
         if file_logging:
-            file_handler = FileHandler("latest.log")
-            file_handler.setLevel("DEBUG")
+            file_handler = RotatingFileHandler(
+                "latest.log",
+                maxBytes=kwargs.get("log_size", 10 * 1024 * 1024),
+                backupCount=kwargs.get("log_backups", 5))
+            file_handler.setLevel(level)
             file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
+            handlers.append(file_handler)
+
+        log_queue = Queue()
+        self.log_listener = QueueListener(
+            log_queue, *handlers, respect_handler_level=True)
+        self.log_listener.start()
+        register_exit(self.log_listener.stop)
+
+        self.logger.addHandler(DeferredQueueHandler(log_queue))
+        self.logger.setLevel(min(handler.level for handler in handlers))
 
-        get_logger("requests").setLevel(get_level_name("WARNING"))
+        get_logger("tornado").setLevel(get_level_name("WARNING"))
 
         self.logger.info("Logger initialized with level '{}'.".format(level))
 
-    def _request(self, url, method="GET", **kwargs):
+    def _init_http_client(self):
+        """Initialize asynchronous HTTP client."""
+
+        try:
+            import pycurl  # noqa: F401
+            AsyncHTTPClient.configure(
+                "tornado.curl_httpclient.CurlAsyncHTTPClient",
+                max_clients=self.max_clients)
+        except ImportError:
+            AsyncHTTPClient.configure(None, max_clients=self.max_clients)
+            self.logger.warning(
+                "Module 'pycurl' unavailable; "
+                "HTTP connections will not be kept alive.")
+
+    @coroutine
+    def _request(self, url, method="GET", params=None, data=None,
+                 timeout=None, endpoint="other", **kwargs):
         """Send HTTP request to Beam."""
-        response = self.http_session.request(
-            method, urljoin(self.path, url.lstrip('/')), **kwargs)
+
+        url = urljoin(self.path, url.lstrip('/'))
+        if params:
+            url = url_concat(url, params)
+
+        headers = {"Accept": "application/json"}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(
+                "{}={}".format(key, morsel.value)
+                for key, morsel in self.cookies.items())
+
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif method in ("POST", "PUT", "PATCH"):
+            body = ''
+
+        request = HTTPRequest(
+            url, method=method, headers=headers, body=body,
+            connect_timeout=self.connect_timeout,
+            request_timeout=timeout or self.request_timeout,
+            **kwargs)
+
+        started = monotonic()
         try:
-            return response.json()
-        except Exception:
-            return response.text
+            response = yield AsyncHTTPClient().fetch(request)
+        except HTTPError as error:
+            if error.response is None:
+                raise
+            response = error.response
+        finally:
+            rest_latency.observe(monotonic() - started, endpoint)
+
+        for cookie in response.headers.get_list("Set-Cookie"):
+            self.cookies.load(cookie)
+
+        text = response.body.decode() if response.body else ''
+        try:
+            return loads(text)
+        except ValueError:
+            return text
+
+    def _cached_request(self, endpoint, url, **kwargs):
+        """Send HTTP request to Beam, sharing cached or in-flight responses."""
+
+        return self.cache.fetch(
+            self._cache_key(endpoint, url, kwargs.get("params")),
+            partial(self._request, url, endpoint=endpoint, **kwargs),
+            self.cache_ttl[endpoint], cacheable=self._cacheable)
+
+    @staticmethod
+    def _cache_key(endpoint, url, params=None):
+        return (endpoint, url, tuple(sorted((params or {}).items())))
+
+    @staticmethod
+    def _cacheable(response):
+        """Check whether a Beam response may be cached."""
+        return isinstance(response, dict) and "error" not in response
 
     def login(self, username, password, code=''):
         """Authenticate and login with Beam."""
@@ -85,16 +249,35 @@ class Beam:
             "password": password,
             "code": code
         }
-        return self._request("/users/login", method="POST", data=packet)
+        return self._request(
+            "/users/login", method="POST", data=packet, endpoint="login")
 
     def get_channel(self, id, **params):
         """Get channel data by username."""
-        return self._request("/channels/{id}".format(id=id), params=params)
+        return self._cached_request(
+            "channel", "/channels/{id}".format(id=id), params=params)
 
-    def get_chat(self, id):
+    def get_user(self, id):
+        """Get user data by ID."""
+        return self._cached_request("user", "/users/{id}".format(id=id))
+
+    def get_chat(self, id, refresh=False):
         """Get chat server data."""
-        return self._request("/chats/{id}".format(id=id))
 
+        url = "/chats/{id}".format(id=id)
+        if refresh:
+            self.cache.invalidate(self._cache_key("chat", url))
+        return self._cached_request("chat", url)
+
+    def get_manifest(self, id, refresh=False):
+        """Get light stream manifest data."""
+
+        url = "/channels/{id}/manifest.light".format(id=id)
+        if refresh:
+            self.cache.invalidate(self._cache_key("manifest", url))
+        return self._cached_request("manifest", url)
+
+    @coroutine
     def connect(self, channel_id, bot_id, silent=False):
         """Connect to a Beam chat through a websocket."""
 
@@ -104,75 +287,193 @@ class Beam:
             "silent": silent
         }
 
-        chat = self.get_chat(channel_id)
+        reply = yield self._connect_chat()
+        if reply is not None:
+            self.read_chat(self.handle)
+            self.handle(reply)
+
+    @coroutine
+    def _connect_chat(self):
+        """Connect and authenticate to chat, retrying with backoff."""
 
-        self.servers = chat["endpoints"]
-        self.server_offset = 0
+        channel_id = self.connection_information["channel_id"]
+        refresh = False
+        delay = self.reconnect_delay
 
-        authkey = chat["authkey"]
+        while not self.closing:
+            try:
+                if self.authkey is None:
+                    chat = yield self.get_chat(channel_id, refresh=refresh)
+                    self.servers = chat["endpoints"]
+                    self.authkey = chat["authkey"]
 
-        self.logger.debug("Connecting to: {server}.".format(
-            server=self.servers[self.server_offset]))
+                if self.connection_information["silent"]:
+                    arguments = (channel_id,)
+                else:
+                    arguments = (
+                        channel_id,
+                        self.connection_information["bot_id"],
+                        self.authkey
+                    )
 
-        websocket_connection = websocket_connect(
-            self.servers[self.server_offset])
+                endpoint, websocket, reply = yield self._race(
+                    self._endpoints(), arguments)
 
-        if silent:
-            websocket_connection.add_done_callback(
-                partial(self.authenticate, channel_id))
-        else:
-            websocket_connection.add_done_callback(
-                partial(self.authenticate, channel_id, bot_id, authkey))
+            except AuthenticationError as error:
+                self.logger.warning(
+                    "Chat authentication failed: {}. Getting a new "
+                    "authkey.".format(error))
+                self.authkey = None
+                refresh = True
 
-    def authenticate(self, *args):
-        """Authenticate session to a Beam chat through a websocket."""
+            except Exception as error:
+                self.logger.warning(
+                    "Failed to connect to chat: {}".format(error))
+
+            else:
+                if self.closing:
+                    websocket.close()
+                    break
+
+                self.websocket = websocket
+                self.endpoint = endpoint
+                self.outbound.resume()
+                self.logger.info("Successfully connected to chat {}.".format(
+                    self.channel_data["token"]))
+                return reply
+
+            wait = uniform(0, delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+            self.logger.info("Reconnecting to chat in {:.1f} seconds.".format(
+                wait))
+            yield sleep(wait)
+
+        return None
+
+    def _endpoints(self):
+        """Get the chat servers to race, skipping those that failed."""
+
+        now = monotonic()
+        endpoints = [
+            endpoint for endpoint in self.servers
+            if self.failed_endpoints.get(endpoint, 0) <= now
+        ]
+        if not endpoints:
+            endpoints = sorted(
+                self.servers, key=lambda endpoint: self.failed_endpoints[
+                    endpoint])
+        return endpoints[:self.race_width]
+
+    def _endpoint_failed(self, endpoint):
+        self.failed_endpoints[endpoint] = monotonic() + self.endpoint_cooldown
 
-        future = args[-1]
+    @coroutine
+    def _race(self, endpoints, arguments):
+        """Authenticate to chat servers at once, keeping the first to reply."""
+
+        self.logger.debug("Connecting to: {}.".format(', '.join(endpoints)))
+
+        attempts = [
+            self._authenticate(endpoint, arguments) for endpoint in endpoints]
+        waiter = WaitIterator(*attempts)
+
+        rejected = None
+        while not waiter.done():
+            try:
+                websocket, reply = yield waiter.next()
+            except AuthenticationError as error:
+                rejected = error
+                continue
+            except Exception as error:
+                endpoint = endpoints[waiter.current_index]
+                self.logger.debug("Failed to connect to {}: {}".format(
+                    endpoint, error))
+                self._endpoint_failed(endpoint)
+                continue
+
+            endpoint = endpoints[waiter.current_index]
+            self.failed_endpoints.pop(endpoint, None)
+
+            for index, attempt in enumerate(attempts):
+                if index != waiter.current_index:
+                    attempt.add_done_callback(self._close_attempt)
+            return endpoint, websocket, reply
+
+        if rejected is not None:
+            raise rejected
+        raise ConnectionError("No chat server could be reached.")
+
+    @staticmethod
+    def _close_attempt(future):
         if future.exception() is None:
-            self.websocket = future.result()
-            self.logger.info("Successfully connected to chat {}.".format(
-                self.channel_data["token"]))
+            future.result()[0].close()
 
-            self.send_message(*args[:-1], method="auth")
+    @coroutine
+    def _authenticate(self, endpoint, arguments):
+        """Connect to a chat server and authenticate."""
 
-            self.read_chat(self.handle)
-        else:
-            raise ConnectionError(future.exception())
+        websocket = yield websocket_connect(
+            endpoint, connect_timeout=self.connect_timeout)
+
+        packet_id = self.message_id
+        self.message_id += 1
+
+        try:
+            websocket.write_message(
+                encode_method("auth", arguments, packet_id))
+
+            while True:
+                message = yield with_timeout(
+                    timedelta(seconds=self.auth_timeout),
+                    websocket.read_message())
+                if message is None:
+                    raise ConnectionError("Connection closed.")
+
+                reply = loads(message)
+                if (reply.get("type") == "reply" and
+                        reply.get("id") == packet_id):
+                    break
+        except Exception:
+            websocket.close()
+            raise
+
+        if reply.get("error") is not None:
+            websocket.close()
+            raise AuthenticationError(reply["error"])
+
+        return websocket, reply
 
     def send_message(self, *args, method="msg"):
         """Send a message to a Beam chat through a websocket."""
 
         if method == "msg":
+            reply = object()
             for message in args:
-                message_packet = {
-                    "type": "method",
-                    "method": "msg",
-                    "arguments": (message,),
-                    "id": self.message_id
-                }
-                self.websocket.write_message(dumps(message_packet))
-                self.message_id += 1
+                self.outbound.put(method, (message,), reply)
+
+        elif method == "auth":
+            self._write_packet(method, args)
 
         else:
-            message_packet = {
-                "type": "method",
-                "method": method,
-                "arguments": args,
-                "id": self.message_id
-            }
-            self.websocket.write_message(dumps(message_packet))
-            self.message_id += 1
+            self.outbound.put(method, args)
 
             if method == "whisper":
-                self.logger.info("$ [{bot_name} > {user}] {message}".format(
-                    bot_name=self.config["auth"]["username"],
-                    user=args[0],
-                    message=args[1]))
+                self.logger.info(
+                    "$ [%s > %s] %s",
+                    self.config["auth"]["username"], args[0], args[1])
+
+    def _write_packet(self, method, arguments):
+        """Write a method packet to the chat websocket."""
+
+        self.websocket.write_message(
+            encode_method(method, arguments, self.message_id))
+        self.message_id += 1
 
     def remove_message(self, channel_id, message_id):
         """Remove a message from chat."""
         return self._request("/chats/{id}/message/{message}".format(
-            id=channel_id, message=message_id), method="DELETE")
+            id=channel_id, message=message_id), method="DELETE",
+            endpoint="remove_message")
 
     @coroutine
     def read_chat(self, handler=None):
@@ -182,147 +483,233 @@ class Beam:
             message = yield self.websocket.read_message()
 
             if message is None:
+                if self.closing:
+                    return
+
                 self.logger.warning(
                     "Connection to chat server lost. Attempting to reconnect.")
-                self.server_offset += 1
-                self.server_offset %= len(self.servers)
-                self.logger.debug("Connecting to: {server}.".format(
-                    server=self.servers[self.server_offset]))
+                self.outbound.pause()
+                reconnects.inc("chat")
+                self._endpoint_failed(self.endpoint)
 
-                websocket_connection = websocket_connect(
-                    self.servers[self.server_offset])
-
-                authkey = self.get_chat(
-                    self.connection_information["channel_id"])["authkey"]
-
-                if self.connection_information["silent"]:
-                    websocket_connection.add_done_callback(
-                        partial(
-                            self.authenticate,
-                            self.connection_information["channel_id"]
-                        )
-                    )
-                else:
-                    websocket_connection.add_done_callback(
-                        partial(
-                            self.authenticate,
-                            self.connection_information["channel_id"],
-                            self.connection_information["bot_id"],
-                            authkey
-                        )
-                    )
+                reply = yield self._connect_chat()
+                if reply is None:
+                    return
+                continue
 
             response = loads(message)
 
-            self.logger.debug("CHAT: {}".format(response))
+            if self.logger.isEnabledFor(DEBUG):
+                self.logger.debug("CHAT: %s", response)
 
             if callable(handler):
                 handler(response)
 
-    def connect_to_liveloading(self, channel_id, user_id):
-        """Connect to Beam liveloading."""
-
-        liveloading_websocket_connection = websocket_connect(
-            "wss://realtime.beam.pro/socket.io/?EIO=3&transport=websocket")
-        liveloading_websocket_connection.add_done_callback(
-            partial(self.subscribe_to_liveloading, channel_id, user_id))
+    def disconnect(self):
+        """Close the chat and liveloading websockets without reconnecting."""
 
-    def subscribe_to_liveloading(self, channel_id, user_id, future):
-        """Subscribe to Beam liveloading."""
+        self.closing = True
 
-        if future.exception() is None:
-            self.liveloading_websocket = future.result()
+        if getattr(self, "websocket", None) is not None:
+            try:
+                self.outbound.flush()
+            except WebSocketClosedError:
+                pass
 
-            self.logger.info(
-                "Successfully connected to liveloading websocket.")
-
-            interfaces = (
-                "channel:{channel_id}:update",
-                "channel:{channel_id}:followed",
-                "channel:{channel_id}:subscribed",
-                "channel:{channel_id}:resubscribed",
-                "user:{user_id}:update"
-            )
-            self.subscribe_to_interfaces(
-                *tuple(
-                    interface.format(channel_id=channel_id, user_id=user_id)
-                    for interface in interfaces
-                )
-            )
+        for websocket in (getattr(self, "websocket", None),
+                          getattr(self, "liveloading_websocket", None)):
+            if websocket is not None:
+                websocket.close()
 
-            self.logger.info(
-                "Successfully subscribed to liveloading interfaces.")
+    def connect_to_liveloading(self, channel_id, user_id):
+        """Connect to Beam liveloading, reconnecting whenever it is lost."""
+
+        interfaces = (
+            "channel:{channel_id}:update",
+            "channel:{channel_id}:followed",
+            "channel:{channel_id}:subscribed",
+            "channel:{channel_id}:resubscribed",
+            "user:{user_id}:update"
+        )
+        self.liveloading_interfaces = tuple(
+            interface.format(channel_id=channel_id, user_id=user_id)
+            for interface in interfaces
+        )
 
-            self.watch_liveloading()
-        else:
-            raise ConnectionError(future.exception())
+        self.watch_liveloading(self.handle_liveloading)
 
     def subscribe_to_interfaces(self, *interfaces):
         """Subscribe to a Beam liveloading interface."""
 
         for interface in interfaces:
-            packet = [
-                "put",
-                {
-                    "method": "put",
-                    "headers": {},
-                    "data": {
-                        "slug": [
-                            interface
-                        ]
-                    },
-                    "url": "/api/v1/live"
-                }
-            ]
-            self.liveloading_websocket.write_message('420' + dumps(packet))
+            self.liveloading_websocket.write_message(
+                encode_subscription(interface))
 
     def parse_liveloading_message(self, message):
-        """Parse a message received from the Beam liveloading websocket."""
+        """Parse a message received from the Beam liveloading websocket.
 
-        sections = match("(\d+)(.+)?$", message).groups()
+        Control frames are not decoded as JSON, and event frames are only
+        decoded if their event is one of liveloading_events.
+        """
 
+        if message.isdigit():
+            return {"code": message, "data": None}
+
+        if message.startswith('42["'):
+            event = message[4:message.find('"', 4)]
+            if event.rpartition(':')[2] in self.liveloading_events:
+                data = loads(message[2:])
+            else:
+                data = None
+            return {"code": "42", "event": event, "data": data}
+
+        data = message.lstrip("0123456789")
         return {
-            "code": sections[0],
-            "data": loads(sections[1]) if sections[1] is not None else None
+            "code": message[:len(message) - len(data)],
+            "data": loads(data) if data else None
         }
 
     @coroutine
     def watch_liveloading(self, handler=None):
         """Watch and handle packets from the Beam liveloading websocket."""
 
-        response = yield self.liveloading_websocket.read_message()
-        if response is None:
-            raise ConnectionError
+        delay = self.reconnect_delay
+
+        while not self.closing:
+            try:
+                self.liveloading_websocket = yield websocket_connect(
+                    self.liveloading_path,
+                    connect_timeout=self.connect_timeout)
+            except Exception as error:
+                self.logger.warning(
+                    "Failed to connect to liveloading: {}".format(error))
+            else:
+                if self.closing:
+                    self.liveloading_websocket.close()
+                    break
+
+                self.logger.info(
+                    "Successfully connected to liveloading websocket.")
+
+                if self.liveloading_lost is not None:
+                    self.liveloading_dead_time += (
+                        monotonic() - self.liveloading_lost)
+                    self.liveloading_lost = None
+
+                connected = monotonic()
+                try:
+                    yield self._read_liveloading(handler)
+                except Exception:
+                    self.logger.exception("Liveloading connection failed.")
+                    self.liveloading_websocket.close()
+
+                self.liveloading_lost = monotonic()
+                if monotonic() - connected > self.max_reconnect_delay:
+                    delay = self.reconnect_delay
+
+                if self.closing:
+                    break
 
-        packet = self.parse_liveloading_message(response)
+                self.logger.warning(
+                    "Connection to liveloading lost. Attempting to "
+                    "reconnect.")
+                self.liveloading_reconnects += 1
+                reconnects.inc("liveloading")
 
-        PeriodicCallback(
-            partial(self.liveloading_websocket.write_message, '2'),
-            packet["data"]["pingInterval"]
-        ).start()
+            wait = uniform(0, delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+            self.logger.info(
+                "Reconnecting to liveloading in {:.1f} seconds.".format(wait))
+            yield sleep(wait)
 
-        while True:
-            message = yield self.liveloading_websocket.read_message()
+    @coroutine
+    def _read_liveloading(self, handler):
+        """Read a liveloading connection until it closes or times out."""
 
-            if message is None:
-                raise ConnectionError
-
-            packet = self.parse_liveloading_message(message)
-
-            if packet.get("data") is not None:
-                self.logger.debug("LIVE: {}".format(packet))
-
-            if isinstance(packet["data"], list):
-                if isinstance(packet["data"][0], str):
-                    if packet["data"][1].get("following"):
-                        self.logger.info("- {} followed.".format(
-                            packet["data"][1]["user"]["username"]))
-                        self.send_message(
-                            "Thanks for the follow, @{}!".format(
-                                packet["data"][1]["user"]["username"]))
-                    elif packet["data"][1].get("subscribed"):
-                        self.logger.info("- {} subscribed.".format(
-                            packet["data"][1]["user"]["username"]))
-                        self.send_message(
-                            "Thanks for the subscription, @{}! <3".format(
-                                packet["data"][1]["user"]["username"]))
+        websocket = self.liveloading_websocket
+
+        message = yield websocket.read_message()
+        if message is None:
+            return
+
+        packet = self.parse_liveloading_message(message)
+        interval = packet["data"]["pingInterval"] / 1000
+        timeout = packet["data"]["pingTimeout"] / 1000
+
+        self.subscribe_to_interfaces(*self.liveloading_interfaces)
+        self.logger.info("Successfully subscribed to liveloading interfaces.")
+
+        self.liveloading_ping = None
+
+        def heartbeat():
+            if self.liveloading_ping is None:
+                self.liveloading_ping = monotonic()
+                websocket.write_message('2')
+            elif monotonic() - self.liveloading_ping > timeout:
+                self.logger.warning("Liveloading heartbeat timed out.")
+                websocket.close()
+
+        heartbeat_timer = PeriodicCallback(heartbeat, interval * 1000)
+        heartbeat_timer.start()
+
+        try:
+            while True:
+                message = yield websocket.read_message()
+
+                if message is None:
+                    return
+
+                try:
+                    packet = self.parse_liveloading_message(message)
+                except ValueError:
+                    self.logger.warning(
+                        "Skipped malformed liveloading frame: %s", message)
+                    continue
+
+                if packet["code"] == '3':
+                    self.liveloading_ping = None
+                    continue
+
+                if (packet.get("data") is not None and
+                        self.logger.isEnabledFor(DEBUG)):
+                    self.logger.debug("LIVE: %s", packet)
+
+                if callable(handler):
+                    try:
+                        handler(packet)
+                    except Exception:
+                        self.logger.exception(
+                            "Failed to handle liveloading packet: %s", packet)
+        finally:
+            heartbeat_timer.stop()
+
+    def liveloading_stats(self):
+        """Get liveloading reconnection statistics."""
+
+        dead_time = self.liveloading_dead_time
+        if self.liveloading_lost is not None:
+            dead_time += monotonic() - self.liveloading_lost
+
+        return {
+            "connected": self.liveloading_lost is None,
+            "reconnects": self.liveloading_reconnects,
+            "dead_time": dead_time
+        }
+
+    def handle_liveloading(self, packet):
+        """Handle packets from the Beam liveloading websocket."""
+
+        if isinstance(packet["data"], list):
+            if isinstance(packet["data"][0], str):
+                if packet["data"][1].get("following"):
+                    self.logger.info(
+                        "- %s followed.",
+                        packet["data"][1]["user"]["username"])
+                    self.announcer.announce(
+                        "follow", packet["data"][1]["user"]["username"])
+                elif packet["data"][1].get("subscribed"):
+                    self.logger.info(
+                        "- %s subscribed.",
+                        packet["data"][1]["user"]["username"])
+                    self.announcer.announce(
+                        "subscribe", packet["data"][1]["user"]["username"])
@@ -0,0 +1,76 @@
+# Benchmark the JSON codec against the standard library on Beam traffic.
+#
+# Usage, from the repository root:
+#     python -m benchmarks.codec [--events 50000] [--replay frames.jsonl]
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from timeit import repeat
+
+import codec
+
+from benchmarks.pipeline import replayed_frames, synthetic_frames
+
+
+def stdlib_encode(method, arguments, id):
+    """Encode a chat method packet the way Beam._write_packet used to."""
+
+    return dumps({
+        "type": "method",
+        "method": method,
+        "arguments": arguments,
+        "id": id
+    })
+
+
+def timed(function, repeats):
+    return min(repeat(function, number=1, repeat=repeats))
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description="Benchmark JSON decoding and encoding of Beam traffic.")
+
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="replay recorded frames")
+    parser.add_argument("--repeat", type=int, default=5)
+
+    parsed = parser.parse_args()
+
+    if parsed.replay:
+        frames = replayed_frames(parsed.replay)
+    else:
+        frames = synthetic_frames(parsed.events, parsed.seed)
+
+    chat = [frame for source, frame in frames if source == "chat"]
+    packets = [
+        ("msg", ("Thanks for the follow, @user{}!".format(index),), index)
+        for index in range(len(chat))
+    ] + [
+        ("whisper", ("user{}".format(index), "Please stop spamming."),
+         index)
+        for index in range(len(chat) // 10)
+    ]
+
+    results = {
+        "decode": (
+            timed(lambda: [loads(frame) for frame in chat], parsed.repeat),
+            timed(lambda: [codec.loads(frame) for frame in chat],
+                  parsed.repeat)
+        ),
+        "encode": (
+            timed(lambda: [stdlib_encode(*packet) for packet in packets],
+                  parsed.repeat),
+            timed(lambda: [codec.encode_method(*packet)
+                           for packet in packets], parsed.repeat)
+        )
+    }
+
+    print("codec: {}".format(codec.name))
+    for stage, count in (("decode", len(chat)), ("encode", len(packets))):
+        stdlib, fast = results[stage]
+        print("{}: json {:.2f} us, {} {:.2f} us, {:.2f}x".format(
+            stage, stdlib / count * 1e6, codec.name, fast / count * 1e6,
+            stdlib / fast))
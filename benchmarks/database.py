@@ -0,0 +1,75 @@
+# Benchmark batched user writes under different SQLite settings.
+#
+# Usage, from the repository root:
+#     python -m benchmarks.database [--rounds 200] [--batch 500]
+
+from argparse import ArgumentParser
+from os.path import join
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+
+from database import DatabaseWriter
+from models import create_session, default_pragmas
+from users import UserStore
+
+settings = (
+    ("rollback journal", {"journal_mode": "DELETE", "synchronous": "FULL"}),
+    ("configured", default_pragmas)
+)
+
+
+def run(pragmas, threaded, rounds, batch, users, seed=0):
+    """Write rounds of counter increments, timing each flush."""
+
+    session = create_session(join(mkdtemp(), "benchmark.db"), pragmas)
+    writer = DatabaseWriter(session) if threaded else None
+    store = UserStore(session, threshold=batch * 2, writer=writer)
+    random = Random(seed)
+
+    blocked = written = 0.0
+
+    for _ in range(rounds):
+        for id in random.sample(range(users), batch):
+            store.increment(store.get(id), "messages")
+        session.commit()
+
+        started = perf_counter()
+        future = store.flush()
+        blocked += perf_counter() - started
+
+        if future is not None:
+            future.result()
+            store.writing.clear()
+        written += perf_counter() - started
+
+    session.close()
+    if writer is not None:
+        writer.shutdown()
+
+    return {
+        "writes_per_second": rounds * batch / written,
+        "blocked_per_flush": blocked / rounds
+    }
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description="Benchmark batched user writes to SQLite.")
+
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--users", type=int, default=20000)
+
+    parsed = parser.parse_args()
+
+    for name, pragmas in settings:
+        for threaded in (False, True):
+            result = run(pragmas, threaded, parsed.rounds, parsed.batch,
+                         parsed.users)
+            print("{}, {}: {:.0f} writes/sec, IOLoop blocked {:.2f} ms "
+                  "per flush".format(
+                      name, "writer thread" if threaded else "IOLoop",
+                      result["writes_per_second"],
+                      result["blocked_per_flush"] * 1000))
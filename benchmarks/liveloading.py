@@ -0,0 +1,90 @@
+# Benchmark liveloading frame parsing against the original regex parser.
+#
+# Usage, from the repository root:
+#     python -m benchmarks.liveloading [--frames 100000] [--repeat 5]
+
+from argparse import ArgumentParser
+from json import dumps, loads
+from logging import getLogger as get_logger
+from random import Random
+from re import match
+from timeit import repeat
+
+from beam import Beam
+from fakebeam import FakeBeam, TrafficGenerator
+
+
+def regex_parse(message):
+    """Parse a frame the way Beam.parse_liveloading_message used to."""
+
+    sections = match("(\\d+)(.+)?$", message).groups()
+
+    return {
+        "code": sections[0],
+        "data": loads(sections[1]) if sections[1] is not None else None
+    }
+
+
+def channel_update(channel):
+    return [
+        "channel:{}:update".format(channel["id"]),
+        {
+            "viewersCurrent": 1234,
+            "viewersTotal": 56789,
+            "numFollowers": 4321,
+            "online": True,
+            "name": "Playing something with a long title, " * 3
+        }
+    ]
+
+
+def frames(count, seed=0):
+    """Generate a realistic mix of liveloading frames."""
+
+    beam = FakeBeam()
+    traffic = TrafficGenerator(beam)
+    random = Random(seed)
+
+    generated = list()
+    for _ in range(count):
+        roll = random.random()
+        if roll < 0.45:
+            generated.append("3")
+        elif roll < 0.50:
+            generated.append("430" + dumps([None, {}]))
+        elif roll < 0.95:
+            generated.append("42" + dumps(channel_update(beam.channel)))
+        else:
+            generated.append("42" + dumps(traffic.follow()))
+    return generated
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description="Benchmark liveloading frame parsing.")
+
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+
+    parsed = parser.parse_args()
+
+    generated = frames(parsed.frames, parsed.seed)
+    beam = Beam(logger=get_logger("benchmark"))
+
+    parsers = (
+        ("regex", regex_parse),
+        ("scanning", beam.parse_liveloading_message)
+    )
+
+    results = dict()
+    for name, parse in parsers:
+        results[name] = min(repeat(
+            lambda: [parse(frame) for frame in generated],
+            number=1, repeat=parsed.repeat))
+        print("{}: {:.0f} frames/sec, {:.3f} us/frame".format(
+            name, len(generated) / results[name],
+            results[name] / len(generated) * 1e6))
+
+    print("speedup: {:.2f}x".format(results["regex"] / results["scanning"]))
@@ -0,0 +1,345 @@
+# Benchmark the CactusBot message pipeline against a stub chat websocket.
+#
+# Usage, from the repository root:
+#     python -m benchmarks.pipeline [--events 20000] [--replay frames.jsonl]
+#                                    [--output results.json]
+#                                    [--compare baseline.json]
+#
+# Replay files contain one JSON object per line, with a "source" of either
+# "chat" or "liveloading" and the raw websocket "frame".
+
+from tornado.gen import coroutine, multi, sleep
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from argparse import ArgumentParser
+from datetime import datetime
+from json import dumps, load, loads
+from os.path import abspath, dirname, join
+from random import Random
+from subprocess import check_output
+from tempfile import mkdtemp
+from time import perf_counter
+import platform
+import tracemalloc
+
+from cactus import Cactus
+import codec
+from fakebeam import FakeBeam, TrafficGenerator, make_application
+from models import Base, bind
+
+root = dirname(dirname(abspath(__file__)))
+
+
+class StubWebSocket:
+    """Chat websocket that records written packets."""
+
+    def __init__(self):
+        self.written = 0
+        self.last_write = None
+
+    def write_message(self, message):
+        self.written += 1
+        self.last_write = perf_counter()
+
+
+class Histogram:
+    """Latency samples, in seconds."""
+
+    def __init__(self):
+        self.samples = list()
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def percentile(self, percent):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent))]
+
+    def summary(self):
+        if not self.samples:
+            return {"count": 0}
+        buckets = dict()
+        for sample in self.samples:
+            bucket = 1e-6
+            while sample > bucket:
+                bucket *= 2
+            key = "{:.6f}".format(bucket)
+            buckets[key] = buckets.get(key, 0) + 1
+        return {
+            "count": len(self.samples),
+            "mean": sum(self.samples) / len(self.samples),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": max(self.samples),
+            "buckets": buckets
+        }
+
+
+def synthetic_frames(count, seed=0):
+    """Generate a mix of chat and liveloading frames."""
+
+    beam = FakeBeam(users=5000)
+    traffic = TrafficGenerator(beam)
+    random = Random(seed)
+
+    frames = list()
+    for _ in range(count):
+        roll = random.random()
+        if roll < 0.80:
+            frames.append(("chat", dumps(traffic.chat_message())))
+        elif roll < 0.90:
+            frames.append(("chat", dumps(traffic.user_join())))
+        elif roll < 0.98:
+            frames.append(("chat", dumps(traffic.user_leave())))
+        else:
+            frames.append(("liveloading", "42" + dumps(traffic.follow())))
+    return frames
+
+
+def replayed_frames(filename):
+    """Read recorded frames from a JSON lines file."""
+
+    with open(filename) as recording:
+        return [
+            (entry["source"], entry["frame"])
+            for entry in map(loads, recording) if entry
+        ]
+
+
+def make_bot(database, api):
+    """Create a bot wired to a stub websocket and a fake Beam API."""
+
+    Base.metadata.create_all(bind(database))
+
+    cactus = Cactus(debug="warning", log_to_file=False, api=api)
+
+    with open(join(root, "data/config-template.json")) as config:
+        cactus.config = load(config)
+    cactus.spam_filter.configure(cactus.config["spam_protection"])
+
+    beam = FakeBeam()
+    cactus.bot_data = beam.bot
+    cactus.channel = beam.channel["token"]
+    cactus.channel_data = beam.channel
+    cactus._init_commands()
+
+    cactus.websocket = StubWebSocket()
+
+    cactus.outbound.rate = cactus.outbound.burst = 1e9
+    cactus.outbound.tokens = 1e9
+
+    return cactus
+
+
+def feed(cactus, source, frame):
+    """Run one frame through the bot, returning any pending handler."""
+
+    if source == "chat":
+        return cactus.handle(codec.loads(frame))
+    return cactus.handle_liveloading(cactus.parse_liveloading_message(frame))
+
+
+@coroutine
+def drained(cactus):
+    """Wait until the outbound queue is empty."""
+
+    while len(cactus.outbound) or cactus.outbound.scheduled:
+        yield sleep(0)
+
+
+@coroutine
+def measure_throughput(cactus, frames):
+    """Feed every frame as fast as possible."""
+
+    started = perf_counter()
+
+    pending = [feed(cactus, source, frame) for source, frame in frames]
+    yield multi([future for future in pending if future is not None])
+    yield drained(cactus)
+
+    elapsed = perf_counter() - started
+    return {
+        "events": len(frames),
+        "seconds": elapsed,
+        "events_per_second": len(frames) / elapsed
+    }
+
+
+@coroutine
+def measure_latency(cactus, frames):
+    """Feed frames one at a time, timing each stage."""
+
+    stages = {
+        name: Histogram()
+        for name in ("decode", "dispatch", "handler", "reply")
+    }
+
+    for source, frame in frames:
+        read = perf_counter()
+        if source == "chat":
+            response = codec.loads(frame)
+        else:
+            response = cactus.parse_liveloading_message(frame)
+        decoded = perf_counter()
+
+        written = cactus.websocket.written
+        if source == "chat":
+            future = cactus.handle(response)
+        else:
+            future = cactus.handle_liveloading(response)
+        dispatched = perf_counter()
+
+        if future is not None:
+            yield future
+        handled = perf_counter()
+
+        yield drained(cactus)
+
+        stages["decode"].add(decoded - read)
+        stages["dispatch"].add(dispatched - decoded)
+        stages["handler"].add(handled - read)
+        if cactus.websocket.written > written:
+            stages["reply"].add(cactus.websocket.last_write - read)
+
+    return {name: stage.summary() for name, stage in stages.items()}
+
+
+@coroutine
+def measure_allocations(cactus, frames):
+    """Trace memory allocated while handling frames."""
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    pending = [feed(cactus, source, frame) for source, frame in frames]
+    yield multi([future for future in pending if future is not None])
+    yield drained(cactus)
+
+    after = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    statistics = after.compare_to(before, "lineno")
+    return {
+        "events": len(frames),
+        "retained_bytes": sum(stat.size_diff for stat in statistics),
+        "retained_blocks": sum(stat.count_diff for stat in statistics),
+        "peak_bytes": peak,
+        "top": [
+            str(stat) for stat in sorted(
+                statistics, key=lambda stat: stat.size_diff,
+                reverse=True)[:10]
+        ]
+    }
+
+
+def version():
+    try:
+        return check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=root
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline):
+    """Print differences from an earlier run."""
+
+    def change(new, old):
+        return "{:+.1f}%".format((new - old) / old * 100) if old else "n/a"
+
+    print("Compared to {}:".format(baseline.get("version")))
+    print("  events/sec: {}".format(change(
+        results["throughput"]["events_per_second"],
+        baseline["throughput"]["events_per_second"])))
+    for stage, summary in results["latency"].items():
+        old = baseline["latency"].get(stage, {})
+        if summary.get("count") and old.get("count"):
+            print("  {} p50: {}, p99: {}".format(
+                stage,
+                change(summary["p50"], old["p50"]),
+                change(summary["p99"], old["p99"])))
+
+
+@coroutine
+def main(parsed):
+    if parsed.replay:
+        frames = replayed_frames(parsed.replay)
+    else:
+        frames = synthetic_frames(parsed.events, parsed.seed)
+
+    socket, port = bind_unused_port()
+    server = HTTPServer(make_application(FakeBeam(port=port)))
+    server.add_sockets([socket])
+
+    cactus = make_bot(
+        join(mkdtemp(), "benchmark.db"),
+        "http://127.0.0.1:{}/api/v1/".format(port))
+
+    results = {
+        "version": version(),
+        "date": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "source": parsed.replay or "synthetic"
+    }
+
+    results["throughput"] = yield measure_throughput(cactus, frames)
+    results["latency"] = yield measure_latency(
+        cactus, frames[:parsed.latency_events])
+    results["allocations"] = yield measure_allocations(
+        cactus, frames[:parsed.allocation_events])
+
+    started = perf_counter()
+    flushed = cactus.users.flush()
+    if flushed is not None:
+        yield flushed
+    results["final_flush_seconds"] = perf_counter() - started
+    results["users"] = {
+        "flushes": cactus.users.flushes,
+        "flush_seconds": cactus.users.flush_time
+    }
+    results["outbound"] = cactus.outbound.stats()
+    results["spam"] = cactus.spam_filter.stats()
+
+    server.stop()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description="Benchmark the CactusBot message pipeline.")
+
+    parser.add_argument("--events", type=int, default=20000,
+                        help="number of synthetic events")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="replay recorded frames")
+    parser.add_argument("--latency-events", type=int, default=2000)
+    parser.add_argument("--allocation-events", type=int, default=2000)
+    parser.add_argument("--output", help="write results to a JSON file")
+    parser.add_argument("--compare", help="compare with earlier results")
+
+    parsed = parser.parse_args()
+
+    results = IOLoop.current().run_sync(lambda: main(parsed))
+
+    print("{:.0f} events/sec".format(
+        results["throughput"]["events_per_second"]))
+    for stage, summary in sorted(results["latency"].items()):
+        if summary["count"]:
+            print("{stage}: p50 {p50:.6f}s, p99 {p99:.6f}s".format(
+                stage=stage, **summary))
+    print("{:.0f} bytes retained per event".format(
+        results["allocations"]["retained_bytes"] /
+        results["allocations"]["events"]))
+
+    if parsed.output:
+        with open(parsed.output, 'w') as output:
+            output.write(dumps(results, indent=2, sort_keys=True))
+
+    if parsed.compare:
+        with open(parsed.compare) as baseline:
+            compare(results, load(baseline))
@@ -0,0 +1,89 @@
+from tornado.gen import coroutine
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class Cache:
+    """Bounded LRU cache with per-entry expiry and single-flight fetches."""
+
+    missing = object()
+
+    def __init__(self, size=256):
+        self.size = size
+
+        self.entries = OrderedDict()
+        self.pending = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Get an unexpired value from the cache."""
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            expiry, value = entry
+            if expiry > monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        return default
+
+    def set(self, key, value, ttl):
+        """Store a value in the cache for ttl seconds."""
+
+        self.entries[key] = (monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """Remove a value, or every value, from the cache."""
+
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    @coroutine
+    def fetch(self, key, fetcher, ttl, cacheable=None):
+        """Get a value from the cache, calling fetcher on a miss.
+
+        Concurrent misses for the same key share a single fetch.
+        """
+
+        value = self.get(key, self.missing)
+        if value is not self.missing:
+            return value
+
+        if key in self.pending:
+            self.coalesced += 1
+            return (yield self.pending[key])
+
+        self.misses += 1
+        future = self.pending[key] = fetcher()
+        try:
+            value = yield future
+        finally:
+            del self.pending[key]
+
+        if cacheable is None or cacheable(value):
+            self.set(key, value, ttl)
+        return value
+
+    def stats(self):
+        """Get cache counters."""
+
+        return {
+            "size": len(self.entries),
+            "pending": len(self.pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced
+        }
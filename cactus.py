@@ -2,17 +2,23 @@
 
 from messages import MessageHandler
 from beam import Beam
+from stalls import StallDetector
+import metrics
 
-from models import Base, engine
+from models import Base, bind, memory_report
 
+from tornado.gen import coroutine
+
+from logging import getLogger as get_logger
 from json import load, dump
 
 from os.path import exists
 from shutil import copyfile
 
 from functools import reduce, partial
+from collections import OrderedDict
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.autoreload import add_reload_hook, watch, start
 
 from sys import exit
@@ -49,21 +55,30 @@ class Cactus(MessageHandler, Beam):
     started = False
     connected = False
 
+    memory_reporter = None
+    memory_report_interval = 600
+
     def __init__(self, **kwargs):
         super(Cactus, self).__init__(**kwargs)
 
         self.debug = kwargs.get("debug", False)
 
         self.config_file = kwargs.get("config_file", "data/config.json")
-        self.stats_file = kwargs.get("stats_file", "data/stats.json")
+        self.stats_file = kwargs.get("stats_file", "data/stats.jsonl")
         self.database = kwargs.get("database", "data/data.db")
 
+        self.config_section = kwargs.get("config_section")
+
         self.silent = kwargs.get("silent", False)
         self.no_messages = kwargs.get("no_messages", False)
 
+        metrics.default_registry.add_collector(self._collect_metrics)
+
     def _init_database(self, database):
         """Ensure the database exists."""
 
+        engine = bind(database, self.config.get("sqlite"))
+
         if exists(database):
             self.logger.info("Found database.")
         else:
@@ -81,8 +96,9 @@ class Cactus(MessageHandler, Beam):
             self.logger.info("Configuration file found. Loading...")
             self.config_file = filename
             with open(filename) as config:
-                self.config = load(config)
-                return self.config
+                self.config = self._select_config(load(config))
+            self._apply_config()
+            return self.config
         else:
             self.logger.warn("Configuration file was not found. Creating...")
             copyfile("data/config-template.json", filename)
@@ -91,79 +107,206 @@ class Cactus(MessageHandler, Beam):
             raise FileNotFoundError("Configuration file not found.")
             exit()
 
+    def _select_config(self, config_data):
+        """Get the configuration of this bot's channel."""
+
+        if self.config_section is None:
+            return config_data
+
+        config = {
+            key: value for key, value in config_data.items()
+            if key != "channels"
+        }
+        for key, value in config_data["channels"][
+                self.config_section].items():
+            if isinstance(value, dict):
+                config[key] = dict(config.get(key, dict()), **value)
+            else:
+                config[key] = value
+        config["channel"] = self.config_section
+        return config
+
+    def _apply_config(self):
+        """Configure components from the loaded configuration."""
+
+        self.spam_filter.configure(self.config["spam_protection"])
+        self.announcer.configure(self.config.get("announcements", dict()))
+        self.points.configure(self.config.get("points", dict()))
+        self.stats.configure(self.config.get("statistics", dict()))
+
     def load_stats(self, filename):
-        """Load statistics file."""
+        """Load statistics of past streams."""
 
-        self.logger.warning("Statistics are not yet implemented.")
-        return dict()
-
-        if exists(filename):
-            self.stats_file = filename
-            self.logger.info("Statistics file found. Loading...")
-            with open(filename) as stats:
-                self.stats = load(stats)
-                return self.stats
-        else:
-            self.logger.warn("Statistics file not found. Creating...")
-            copyfile("data/stats-template.json", "data/stats.json")
-            self.logger.info("Statistics file created.")
+        self.stats_file = filename
+        return self.stats.load(filename)
 
     def update_config(self, keys, value):
         """Update configuration file value."""
 
+        keys = keys.split('.')
+        if self.config_section is not None:
+            keys = ["channels", self.config_section] + keys
+
         with open(self.config_file, 'r') as config:
             config_data = load(config)
-            reduce(lambda d, k: d[k], keys.split('.')[:-1], config_data)[
-                keys.split('.')[-1]] = value
+            reduce(lambda d, k: d.setdefault(k, dict()), keys[:-1],
+                   config_data)[keys[-1]] = value
         with open(self.config_file, 'w+') as config:
             dump(config_data, config, indent=2, sort_keys=True)
-        self.config = config_data
+        self.config = self._select_config(config_data)
+        self._apply_config()
         return self.config
 
-    def update_stats(self, keys, value):
-        """Update statistics file value."""
-
-        self.logger.warning("Statistics are not yet implemented.")
-        return
-
-        with open(self.stats_file, 'r') as stats:
-            stats_data = load(stats)
-            reduce(lambda d, k: d[k], keys.split('.')[:-1], stats_data)[
-                keys.split('.')[-1]] = value
-        with open(self.stats_file, 'w+') as stats:
-            dump(stats_data, stats, indent=2, sort_keys=True)
-        self.stats = stats_data
-        return self.stats
+    def update_stats(self, counter, amount=1):
+        """Add to a statistics counter of the current stream."""
+        self.stats.record(counter, amount)
+
+    def _collect_metrics(self):
+        """Update gauges that are read from other components."""
+
+        channel = self.config_section or self.config_file
+        outbound = self.outbound.stats()
+        metrics.outbound_depth.set(outbound["depth"], channel)
+        metrics.outbound_wait.set(outbound["max_wait"], channel)
+        metrics.liveloading_dead_time.set(
+            self.liveloading_stats()["dead_time"], channel)
+
+        spam = self.spam_filter.stats()
+        metrics.spam_evaluations.set(spam["evaluations"], channel)
+        metrics.spam_evaluation_time.set(spam["evaluation_time"], channel)
+        for rule, hits in spam["hits"].items():
+            metrics.spam_hits.set(hits, channel, rule)
+
+        metrics.cached_users.set(len(self.users), channel)
+        metrics.present_viewers.set(len(self.points), channel)
+        for model, count in memory_report(self.session).items():
+            metrics.orm_objects.set(count, channel, model)
+        for structure, count in self.memory_sizes().items():
+            metrics.memory_entries.set(count, channel, structure)
+
+    def memory_sizes(self):
+        """Count the entries of in-memory structures that grow with use."""
+
+        return OrderedDict((
+            ("cached_users", len(self.users)),
+            ("buffered_joins", len(self.users.joined)),
+            ("leaderboard_values", sum(
+                len(values) for values in self.leaderboard.values.values())),
+            ("leaderboard_rankings", sum(
+                len(ranking)
+                for ranking in self.leaderboard.rankings.values())),
+            ("present_viewers", len(self.points)),
+            ("followed_users", len(self.announcer.followed)),
+            ("commands", len(self.command_index.commands)),
+            ("streams", len(self.stats.streams))
+        ))
+
+    def report_memory(self):
+        """Log the size of in-memory structures and the session."""
+
+        sizes = self.memory_sizes()
+        objects = memory_report(self.session)
+        self.logger.info(
+            "Memory: %s (%d users evicted), session holds %s.",
+            ', '.join(
+                "{} {}".format(count, structure.replace('_', ' '))
+                for structure, count in sizes.items()),
+            self.users.evictions,
+            ', '.join(
+                "{} {}".format(count, model)
+                for model, count in sorted(objects.items())
+            ) or "nothing")
+        return sizes
+
+    @coroutine
+    def start(self, bot_data=None):
+        """Log in, unless already logged in, and connect to the channel.
+
+        Starting stops early if the bot is stopped and disconnected while
+        it is still starting.
+        """
+
+        self.closing = False
+
+        if bot_data is None:
+            bot_data = yield self.login(**self.config["auth"])
+            if self.closing:
+                return
+            self.logger.info("Authenticated as: {}.".format(
+                bot_data["username"]))
+        self.bot_data = bot_data
+
+        self.started = True
+
+        self.channel = self.config["channel"]
+        self.channel_data = yield self.get_channel(self.channel)
+        if self.closing:
+            return
+
+        self._init_commands()
+        if not self.leaderboard.loaded:
+            self.leaderboard.load()
+        self.users.start()
+        self.points.start()
+        self.stats.start()
+        self.command_index.start()
+
+        if self.memory_reporter is None:
+            self.memory_reporter = PeriodicCallback(
+                self.report_memory, self.memory_report_interval * 1000)
+            self.memory_reporter.start()
+
+        yield self.update_stream(restarted=True)
+        if self.closing:
+            return
+
+        yield self.connect(
+            self.channel_data["id"],
+            self.bot_data["id"],
+            silent=self.silent)
+        if self.closing:
+            return
+
+        self.connect_to_liveloading(
+            self.channel_data["id"],
+            self.channel_data["userId"])
+
+    def stop(self, message=None):
+        """Stop timers and save changes, optionally sending a last message."""
+
+        if "repeat" in self.commands:
+            self.commands["repeat"].stop()
+
+        self.points.stop()
+        self.users.stop()
+        self.stats.stop()
+        self.command_index.stop()
+
+        if self.memory_reporter is not None:
+            self.memory_reporter.stop()
+            self.memory_reporter = None
+
+        if message is not None:
+            try:
+                self.send_message(message)
+                self.outbound.flush()
+            except Exception:
+                pass
 
     def run(self, *args, **kwargs):
         """Run bot."""
 
         self.logger.info(cactus_art)
-        self._init_database(self.database)
         self.load_config(filename=self.config_file)
+        self._init_database(self.database)
         self.load_stats(filename=self.stats_file)
 
+        self.stall_detector = init_monitoring(self.config, self.cache)
+
         while self.config.get("autorestart") or not self.started:
             try:
-                self.bot_data = self.login(**self.config["auth"])
-                self.logger.info("Authenticated as: {}.".format(
-                    self.bot_data["username"]))
-
-                self.started = True
-
-                self.channel = self.config["channel"]
-                self.channel_data = self.get_channel(self.channel)
-
-                self._init_commands()
-
-                self.connect(
-                    self.channel_data["id"],
-                    self.bot_data["id"],
-                    silent=self.silent)
-
-                self.connect_to_liveloading(
-                    self.channel_data["id"],
-                    self.channel_data["userId"])
+                loop = IOLoop.instance()
+                loop.run_sync(self.start)
 
                 if str(self.debug).lower() in ("true", "debug"):
                     add_reload_hook(partial(
@@ -173,15 +316,13 @@ class Cactus(MessageHandler, Beam):
                     watch(self.config_file)
                     start(check_time=5000)
 
-                IOLoop.instance().start()
+                loop.start()
 
             except KeyboardInterrupt:
                 print()
                 self.logger.info("Removing thorns... done.")
                 try:
-                    self.send_message("CactusBot deactivated! :cactus")
-                except Exception:
-                    pass
+                    self.stop("CactusBot deactivated! :cactus")
                 finally:
                     exit()
 
@@ -189,9 +330,9 @@ class Cactus(MessageHandler, Beam):
                 self.logger.critical("Oh no, I crashed!")
 
                 try:
-                    self.send_message("Oh no, I crashed! :127")
+                    self.stop("Oh no, I crashed! :127")
                 except Exception:
-                    pass
+                    self.logger.error("Failed to save users and commands.")
 
                 self.logger.error('\n\n' + format_exc())
 
@@ -206,6 +347,34 @@ class Cactus(MessageHandler, Beam):
                     self.logger.info("CactusBot deactivated.")
                     exit()
 
+
+def init_monitoring(config, cache, serve_metrics=True):
+    """Start the stall detector and, if enabled, the metrics server."""
+
+    stall_detector = StallDetector(**config.get("stall_detector", dict()))
+    stall_detector.start()
+
+    def collect():
+        metrics.cache_lookups.set(cache.hits, "hit")
+        metrics.cache_lookups.set(cache.misses, "miss")
+        metrics.cache_lookups.set(cache.coalesced, "coalesced")
+
+        metrics.stalls.set(stall_detector.stalls)
+        metrics.stall_time.set(stall_detector.stall_time)
+
+    metrics.default_registry.add_collector(collect)
+
+    metrics_config = config.get("metrics", dict())
+    if serve_metrics and metrics_config.get("enabled", False):
+        metrics.start_server(
+            metrics_config.get("port", 9100),
+            metrics_config.get("address", ''))
+        get_logger("CactusBot").info("Serving metrics on port {}.".format(
+            metrics_config.get("port", 9100)))
+
+    return stall_detector
+
+
 if __name__ == "__main__":
 
     parser = ArgumentParser()
@@ -225,6 +394,18 @@ if __name__ == "__main__":
         default="info"
     )
 
+    parser.add_argument(
+        "--api",
+        help="use a custom Beam API URL",
+        default=None
+    )
+
+    parser.add_argument(
+        "--liveloading",
+        help="use a custom Beam liveloading websocket URL",
+        default=None
+    )
+
     parsed = parser.parse_args()
 
     cactus = Cactus(**parsed.__dict__)
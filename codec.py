@@ -0,0 +1,36 @@
+# JSON encoding and decoding, using the fastest available library.
+
+try:
+    from orjson import loads, dumps as orjson_dumps
+
+    def dumps(value):
+        return orjson_dumps(value).decode()
+
+    name = "orjson"
+except ImportError:
+    try:
+        from ujson import loads, dumps
+        name = "ujson"
+    except ImportError:
+        from json import loads, dumps  # noqa: F401
+        name = "json"
+
+method_prefixes = dict()
+
+subscription_prefix = '420["put",{"method":"put","headers":{},"data":{"slug":['
+subscription_suffix = ']},"url":"/api/v1/live"}]'
+
+
+def encode_method(method, arguments, id):
+    """Encode a chat method packet, reusing its serialized envelope."""
+
+    prefix = method_prefixes.get(method)
+    if prefix is None:
+        prefix = method_prefixes[method] = (
+            '{"type":"method","method":' + dumps(method) + ',"arguments":')
+    return prefix + dumps(arguments) + ',"id":' + str(id) + '}'
+
+
+def encode_subscription(interface):
+    """Encode a liveloading subscription packet."""
+    return subscription_prefix + dumps(interface) + subscription_suffix
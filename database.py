@@ -0,0 +1,54 @@
+from models import session_scope
+
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+
+class DatabaseWriter:
+    """Run blocking database work on a single background thread.
+
+    Each job runs in its own short-lived session, which is committed when
+    the job returns. Jobs run in the order they were submitted, and the
+    returned futures can be yielded from coroutines.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.pending = 0
+        self.completed = 0
+        self.busy_time = 0.0
+
+    def run(self, function, *args, **kwargs):
+        """Run function(session, *args, **kwargs) on the writer thread."""
+
+        self.pending += 1
+        return self.executor.submit(self._run, function, args, kwargs)
+
+    def _run(self, function, args, kwargs):
+        started = monotonic()
+        try:
+            with session_scope(self.session.bind) as session:
+                return function(session, *args, **kwargs)
+        finally:
+            self.busy_time += monotonic() - started
+            self.pending -= 1
+            self.completed += 1
+
+    def wait(self):
+        """Block until every job submitted so far has finished."""
+        self.executor.submit(lambda: None).result()
+
+    def shutdown(self):
+        """Finish pending jobs and stop the writer thread."""
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        """Get job counts and time spent writing."""
+
+        return {
+            "pending": self.pending,
+            "completed": self.completed,
+            "busy_time": self.busy_time
+        }
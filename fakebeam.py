@@ -0,0 +1,451 @@
+# Fake Beam, for testing CactusBot offline.
+
+from tornado.web import Application, RequestHandler
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from logging import getLogger as get_logger
+from logging import basicConfig as basic_config
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from json import dumps, loads
+from random import choice, randint, random
+from uuid import uuid4
+
+messages = (
+    "Hello!",
+    "hi everyone :D",
+    "What game is this?",
+    "PogChamp",
+    "!uptime",
+    "!cactus",
+    "!points",
+    "!social twitter",
+    "WHY ARE WE SHOUTING",
+    "check out http://example.com",
+    "lol",
+    "gg"
+)
+
+
+class FakeBeam:
+    """State of a fake Beam server."""
+
+    def __init__(self, channel="CactusBot", bot="CactusBot", users=1000,
+                 port=8080):
+        self.port = port
+
+        self.bot = {"id": 1, "username": bot}
+        self.channel = {
+            "id": 2,
+            "token": channel,
+            "userId": 3,
+            "online": True,
+            "user": {
+                "id": 3,
+                "username": channel,
+                "social": {
+                    "twitter": "https://twitter.com/" + channel,
+                    "youtube": "https://youtube.com/" + channel
+                }
+            }
+        }
+        self.users = [
+            {"id": 100 + index, "username": "user{}".format(index)}
+            for index in range(users)
+        ]
+
+        self.since = datetime.utcnow() - timedelta(hours=1)
+
+        self.ping_interval = 25000
+        self.ping_timeout = 60000
+        self.pong = True
+
+        self.authkeys = set()
+
+        self.chats = set()
+        self.liveloading = set()
+
+        self.received = 0
+        self.deleted = 0
+
+        self.logger = get_logger("FakeBeam")
+
+    def get_channel(self, id):
+        if id in (str(self.channel["id"]), self.channel["token"]):
+            return self.channel
+        for user in self.users:
+            if id == user["username"]:
+                return {
+                    "id": user["id"],
+                    "token": id,
+                    "userId": user["id"],
+                    "online": False,
+                    "user": dict(user, social={})
+                }
+        return None
+
+    def channel_update(self, **changes):
+        return [
+            "channel:{}:update".format(self.channel["id"]),
+            dict(changes, online=self.channel["online"])
+        ]
+
+    def toggle_stream(self):
+        """Go live or offline, and announce it on liveloading."""
+
+        self.channel["online"] = not self.channel["online"]
+        if self.channel["online"]:
+            self.since = datetime.utcnow()
+        self.broadcast_liveloading([self.channel_update()])
+
+    def broadcast_chat(self, packets):
+        self._broadcast(self.chats, [dumps(packet) for packet in packets])
+
+    def broadcast_liveloading(self, packets):
+        self._broadcast(
+            self.liveloading, ["42" + dumps(packet) for packet in packets])
+
+    @staticmethod
+    def _broadcast(sockets, messages):
+        for socket in list(sockets):
+            for message in messages:
+                if not socket.send(message):
+                    break
+
+
+class TrafficGenerator:
+    """Synthetic chat, join, leave, follow and channel update traffic."""
+
+    tick = 0.01
+
+    def __init__(self, beam, chat=10, join=1, leave=1, follow=0.1,
+                 update=0.2):
+        self.beam = beam
+        self.rates = {
+            "chat": chat,
+            "join": join,
+            "leave": leave,
+            "follow": follow,
+            "update": update
+        }
+        self.owed = dict.fromkeys(self.rates, 0.0)
+        self.sent = dict.fromkeys(self.rates, 0)
+
+        self.generators = {
+            "chat": self.chat_message,
+            "join": self.user_join,
+            "leave": self.user_leave,
+            "follow": self.follow,
+            "update": self.channel_update
+        }
+
+        self.timer = PeriodicCallback(self.generate, self.tick * 1000)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def generate(self):
+        """Emit the events owed since the last tick."""
+
+        for kind, rate in self.rates.items():
+            self.owed[kind] += rate * self.tick
+            count = int(self.owed[kind])
+            if not count:
+                continue
+            self.owed[kind] -= count
+            self.sent[kind] += count
+
+            packets = [self.generators[kind]() for _ in range(count)]
+            if kind in ("follow", "update"):
+                self.beam.broadcast_liveloading(packets)
+            else:
+                self.beam.broadcast_chat(packets)
+
+    def chat_message(self):
+        user = choice(self.beam.users)
+        text = choice(messages)
+        chunks = [{"type": "text", "data": text}]
+        if random() < 0.1:
+            chunks.append({"type": "emoticon", "text": ":cactus"})
+        return {
+            "type": "event",
+            "event": "ChatMessage",
+            "data": {
+                "channel": self.beam.channel["id"],
+                "id": str(uuid4()),
+                "user_name": user["username"],
+                "user_id": user["id"],
+                "user_roles": ["User"],
+                "message": {"message": chunks, "meta": {}}
+            }
+        }
+
+    def user_join(self):
+        user = choice(self.beam.users)
+        return {
+            "type": "event",
+            "event": "UserJoin",
+            "data": {
+                "originatingChannel": self.beam.channel["id"],
+                "username": user["username"],
+                "roles": ["User"],
+                "id": user["id"]
+            }
+        }
+
+    def user_leave(self):
+        packet = self.user_join()
+        packet["event"] = "UserLeave"
+        return packet
+
+    def follow(self):
+        user = choice(self.beam.users)
+        return [
+            "channel:{}:followed".format(self.beam.channel["id"]),
+            {"user": user, "following": True}
+        ]
+
+    def channel_update(self):
+        return self.beam.channel_update(
+            viewersCurrent=randint(1, len(self.beam.users)))
+
+
+class BeamHandler(RequestHandler):
+
+    def initialize(self, beam):
+        self.beam = beam
+
+    def check_xsrf_cookie(self):
+        pass
+
+    def respond(self, data, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(dumps(data))
+
+    def not_found(self):
+        self.respond({
+            "statusCode": 404,
+            "error": "Not Found",
+            "message": "Not Found"
+        }, status=404)
+
+
+class LoginHandler(BeamHandler):
+
+    def post(self):
+        self.set_cookie("beam-session", str(uuid4()))
+        self.respond(dict(
+            self.beam.bot, username=self.get_body_argument(
+                "username", self.beam.bot["username"])))
+
+
+class ChannelHandler(BeamHandler):
+
+    def get(self, id):
+        channel = self.beam.get_channel(id)
+        if channel is None:
+            return self.not_found()
+        self.respond(channel)
+
+
+class UserHandler(BeamHandler):
+
+    def get(self, id):
+        for user in self.beam.users:
+            if int(id) == user["id"]:
+                return self.respond(user)
+        self.not_found()
+
+
+class ManifestHandler(BeamHandler):
+
+    def get(self, id):
+        if not self.beam.channel["online"]:
+            return self.respond({"since": None})
+        self.respond({
+            "since": self.beam.since.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        })
+
+
+class ChatHandler(BeamHandler):
+
+    def get(self, id):
+        authkey = uuid4().hex
+        self.beam.authkeys.add(authkey)
+        self.respond({
+            "endpoints": [
+                "ws://localhost:{}/chat".format(self.beam.port),
+                "ws://127.0.0.1:{}/chat".format(self.beam.port)
+            ],
+            "authkey": authkey
+        })
+
+
+class DeleteMessageHandler(BeamHandler):
+
+    def delete(self, id, message):
+        self.beam.deleted += 1
+        self.respond({})
+
+
+class BeamSocket(WebSocketHandler):
+
+    def initialize(self, beam):
+        self.beam = beam
+
+    def check_origin(self, origin):
+        return True
+
+    def send(self, message):
+        """Write a message, dropping the socket if the client is gone."""
+
+        try:
+            self.write_message(message)
+        except WebSocketClosedError:
+            self.on_close()
+            return False
+        return True
+
+
+class ChatSocket(BeamSocket):
+
+    def on_message(self, message):
+        packet = loads(message)
+        self.beam.received += 1
+
+        if packet.get("method") == "auth":
+            arguments = packet.get("arguments", [])
+            if len(arguments) > 2 and arguments[2] not in self.beam.authkeys:
+                self.send(dumps({
+                    "type": "reply",
+                    "error": "UNOTFOUND",
+                    "id": packet.get("id"),
+                    "data": None
+                }))
+                return
+            self.beam.chats.add(self)
+            data = {
+                "authenticated": len(arguments) > 2,
+                "roles": ["Owner"] if len(arguments) > 2 else []
+            }
+        else:
+            data = {"arguments": packet.get("arguments")}
+
+        self.send(dumps({
+            "type": "reply",
+            "error": None,
+            "id": packet.get("id"),
+            "data": data
+        }))
+
+    def on_close(self):
+        self.beam.chats.discard(self)
+
+
+class LiveloadingSocket(BeamSocket):
+
+    def open(self):
+        self.send("0" + dumps({
+            "sid": uuid4().hex,
+            "upgrades": [],
+            "pingInterval": self.beam.ping_interval,
+            "pingTimeout": self.beam.ping_timeout
+        }))
+        if self.send("40"):
+            self.beam.liveloading.add(self)
+
+    def on_message(self, message):
+        if message == "2":
+            if self.beam.pong:
+                self.send("3")
+        elif message.startswith("42"):
+            ack = message[2:message.index("[")]
+            if ack:
+                self.send("43" + ack + dumps([None, {}]))
+
+    def on_close(self):
+        self.beam.liveloading.discard(self)
+
+
+def make_application(beam):
+    """Create the fake Beam web application."""
+
+    arguments = {"beam": beam}
+    return Application([
+        (r"/api/v1/users/login", LoginHandler, arguments),
+        (r"/api/v1/users/(\d+)", UserHandler, arguments),
+        (r"/api/v1/channels/([^/]+)/manifest.light", ManifestHandler,
+         arguments),
+        (r"/api/v1/channels/([^/]+)", ChannelHandler, arguments),
+        (r"/api/v1/chats/(\d+)/message/([^/]+)", DeleteMessageHandler,
+         arguments),
+        (r"/api/v1/chats/(\d+)", ChatHandler, arguments),
+        (r"/chat", ChatSocket, arguments),
+        (r"/socket.io/", LiveloadingSocket, arguments)
+    ])
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(description="Run a fake Beam server.")
+
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--channel", default="CactusBot")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="number of synthetic viewers")
+    parser.add_argument("--chat-rate", type=float, default=10,
+                        help="chat messages per second")
+    parser.add_argument("--join-rate", type=float, default=1,
+                        help="joins per second")
+    parser.add_argument("--leave-rate", type=float, default=1,
+                        help="leaves per second")
+    parser.add_argument("--follow-rate", type=float, default=0.1,
+                        help="follows per second")
+    parser.add_argument("--update-rate", type=float, default=0.2,
+                        help="channel viewer count updates per second")
+    parser.add_argument("--stream-length", type=float, default=0,
+                        help="seconds between going live and offline")
+
+    parsed = parser.parse_args()
+
+    basic_config(level="INFO", format="%(asctime)s %(name)s %(message)s")
+    get_logger("tornado.access").setLevel("WARNING")
+
+    beam = FakeBeam(
+        channel=parsed.channel, users=parsed.users, port=parsed.port)
+    make_application(beam).listen(parsed.port)
+
+    traffic = TrafficGenerator(
+        beam,
+        chat=parsed.chat_rate,
+        join=parsed.join_rate,
+        leave=parsed.leave_rate,
+        follow=parsed.follow_rate,
+        update=parsed.update_rate
+    )
+    traffic.start()
+
+    if parsed.stream_length:
+        PeriodicCallback(
+            beam.toggle_stream, parsed.stream_length * 1000).start()
+
+    def report():
+        beam.logger.info(
+            "Sent {sent}; received {received} packets, {deleted} deletions."
+            .format(sent=traffic.sent, received=beam.received,
+                    deleted=beam.deleted))
+
+    PeriodicCallback(report, 10000).start()
+
+    beam.logger.info("Fake Beam listening on port {}.".format(parsed.port))
+    beam.logger.info("Run CactusBot with --api http://localhost:{port}/api/v1/"
+                     " --liveloading ws://localhost:{port}/socket.io/"
+                     .format(port=parsed.port))
+
+    IOLoop.current().start()
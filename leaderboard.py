@@ -0,0 +1,131 @@
+from models import User
+
+from bisect import bisect_left, insort
+from logging import getLogger as get_logger
+
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    SortedList = None
+
+
+class BisectList:
+    """Sorted list kept with bisect, for when sortedcontainers is missing.
+
+    Lookups are O(log n), but insertions and removals move memory, so they
+    are O(n).
+    """
+
+    def __init__(self, iterable=()):
+        self.items = sorted(iterable)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def add(self, value):
+        insort(self.items, value)
+
+    def remove(self, value):
+        del self.items[bisect_left(self.items, value)]
+
+    def bisect_left(self, value):
+        return bisect_left(self.items, value)
+
+
+class Leaderboard:
+    """Users ranked by points and message counts, kept in memory.
+
+    Rankings are loaded once, then updated as counters change. Each ranking
+    is a sorted list of (-value, id) pairs, so the top users come first and
+    a user's rank is a binary search.
+    """
+
+    fields = ("points", "messages")
+
+    def __init__(self, session, rebuild_fraction=0.125):
+        self.session = session
+        self.rebuild_fraction = rebuild_fraction
+
+        self.logger = get_logger("CactusBot")
+
+        if SortedList is None:
+            self.sorted_list = BisectList
+            self.logger.warning(
+                "Module 'sortedcontainers' unavailable; "
+                "leaderboard updates will be slower.")
+        else:
+            self.sorted_list = SortedList
+
+        self.values = {field: dict() for field in self.fields}
+        self.rankings = {field: self.sorted_list() for field in self.fields}
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.values["points"])
+
+    def load(self):
+        """Rank every user in the database."""
+
+        rows = self.session.query(User.id, User.points, User.messages).all()
+        self.session.commit()
+
+        for field in self.fields:
+            self.values[field] = {
+                row.id: getattr(row, field) or 0 for row in rows}
+            self._rebuild(field)
+
+        self.loaded = True
+        self.logger.debug("Ranked %d users.", len(rows))
+
+    def _rebuild(self, field):
+        self.rankings[field] = self.sorted_list(
+            (-value, id) for id, value in self.values[field].items())
+
+    def update(self, id, field, value):
+        """Set a user's counter, moving the user in the ranking."""
+
+        values = self.values[field]
+        previous = values.get(id)
+        if previous == value:
+            return
+
+        ranking = self.rankings[field]
+        if previous is not None:
+            ranking.remove((-previous, id))
+        ranking.add((-value, id))
+        values[id] = value
+
+    def add(self, ids, field, amount):
+        """Add to the counter of many users at once."""
+
+        values = self.values[field]
+        if len(ids) < len(values) * self.rebuild_fraction:
+            for id in ids:
+                self.update(id, field, values.get(id, 0) + amount)
+            return
+
+        for id in ids:
+            values[id] = values.get(id, 0) + amount
+        self._rebuild(field)
+
+    def ranked(self, field):
+        """Get the number of users ranked by a counter."""
+        return len(self.rankings[field])
+
+    def top(self, field, count=5):
+        """Get the ids and values of the highest ranked users."""
+        return [(id, -value) for value, id in self.rankings[field][:count]]
+
+    def rank(self, field, id):
+        """Get a user's rank and value, or None if the user is unranked.
+
+        Users with equal values share a rank.
+        """
+
+        value = self.values[field].get(id)
+        if value is None:
+            return None
+        return self.rankings[field].bisect_left((-value,)) + 1, value
@@ -1,15 +1,44 @@
 from beam import Beam
-from models import (Command, User, session, CommandCommand, QuoteCommand,
+from users import UserStore
+from points import PointsEngine
+from leaderboard import Leaderboard
+from stats import Statistics
+from database import DatabaseWriter
+from spam import SpamFilter
+from models import (CommandIndex, session, CommandCommand, QuoteCommand,
                     CubeCommand, SocialCommand, UptimeCommand, PointsCommand,
                     TemmieCommand, FriendCommand, SpamProtCommand, ProCommand,
-                    SubCommand, RepeatCommand)
+                    SubCommand, RepeatCommand, TopCommand, RankCommand,
+                    StatsCommand)
 
-from re import findall
+from metrics import chat_events, handler_latency, commands, spam_removals
+
+from tornado.gen import coroutine
+from tornado.concurrent import is_future
+from tornado.ioloop import IOLoop
+
+from functools import partial
+from logging import INFO
+from time import monotonic
 
 
 class MessageHandler(Beam):
+
+    liveloading_events = Beam.liveloading_events + ("update",)
+
     def __init__(self, *args, **kwargs):
         super(MessageHandler, self).__init__(*args, **kwargs)
+        self.session = kwargs.get("session") or session
+        self.writer = DatabaseWriter(self.session)
+        self.leaderboard = Leaderboard(self.session)
+        self.users = UserStore(
+            self.session, writer=self.writer, leaderboard=self.leaderboard)
+        self.points = PointsEngine(self.users, self.writer)
+        self.stats = Statistics()
+        self.spam_filter = SpamFilter()
+        self.command_index = CommandIndex(self.session, self.writer)
+        self.commands = dict()
+        self.handled = 0
         self.events = {
             "ChatMessage": self.message_handler,
             "UserJoin": self.join_handler,
@@ -19,20 +48,32 @@ class MessageHandler(Beam):
     def _init_commands(self):
         """Initialize built-in commands."""
 
+        self.command_index.load()
+
+        if "repeat" in self.commands:
+            self.commands["repeat"].stop()
+
         self.commands = {
             "cactus": "Ohai! I'm CactusBot. :cactus",
             "test": "Test confirmed. :cactus",
             "help": "Check out my documentation at cactusbot.readthedocs.org.",
-            "command": CommandCommand(),
+            "command": CommandCommand(self.command_index),
             "repeat": RepeatCommand(
                 self.send_message,
                 self.bot_data["username"],
-                self.channel_data["token"]),
-            "quote": QuoteCommand(),
+                self.channel_data["token"],
+                self.command_index),
+            "quote": QuoteCommand(self.writer),
             "social": SocialCommand(self.get_channel),
-            "uptime": UptimeCommand(self._request),
-            "friend": FriendCommand(self.get_channel),
-            "points": PointsCommand(self.config["points"]["name"]),
+            "uptime": UptimeCommand(self.get_manifest),
+            "friend": FriendCommand(self.get_channel, self.users),
+            "points": PointsCommand(self.config["points"]["name"], self.users),
+            "top": TopCommand(
+                self.config["points"]["name"], self.leaderboard,
+                self.get_user),
+            "rank": RankCommand(
+                self.config["points"]["name"], self.leaderboard),
+            "stats": StatsCommand(self.stats),
             "spamprot": SpamProtCommand(self.update_config),
             "pro": ProCommand(),
             "sub": SubCommand(),
@@ -46,15 +87,41 @@ class MessageHandler(Beam):
         data = response["data"]
 
         if "event" in response:
+            self.handled += 1
+            chat_events.inc(response["event"])
             if response["event"] in self.events:
-                self.events[response["event"]](data)
+                handler = self.events[response["event"]]
+                started = monotonic()
+                result = handler(data)
+                if is_future(result):
+                    result.add_done_callback(partial(
+                        self._observe_handler, handler.__name__, started))
+                else:
+                    self._observe_handler(handler.__name__, started)
+                return result
             else:
-                self.logger.debug("No handler found for event {}.".format(
-                    response["event"]
-                ))
+                self.logger.debug(
+                    "No handler found for event %s.", response["event"])
         elif isinstance(data, dict) and data.get("authenticated"):
             self.send_message("CactusBot activated. Enjoy! :cactus")
 
+    def _observe_handler(self, name, started, future=None):
+        handler_latency.observe(monotonic() - started, name)
+        if future is not None and future.exception() is not None:
+            self.logger.error(
+                "Failed to handle %s.", name, exc_info=future.exception())
+
+    @coroutine
+    def _remove_message(self, data):
+        """Remove a chat message, logging instead of raising on failure."""
+
+        try:
+            yield self.remove_message(data["channel"], data["id"])
+        except Exception:
+            self.logger.exception(
+                "Failed to remove message from {}.".format(data["user_name"]))
+
+    @coroutine
     def message_handler(self, data):
         """Handle chat message packets from Beam."""
 
@@ -63,68 +130,39 @@ class MessageHandler(Beam):
             for chunk in data["message"]["message"]
         ])
 
-        self.logger.info("{bot}{me}[{user}] {message}".format(
-            bot='$ ' if data["user_name"] == self.config["auth"]["username"]
-                else '',
-            me='*' if data["message"]["meta"].get("me") else '',
-            user=data["user_name"] + " > " + self.config["auth"]["username"]
-                if data["message"]["meta"].get("whisper")
-                else data["user_name"],
-            message=parsed)
-        )
-
-        user = session.query(User).filter_by(id=data["user_id"]).first()
-        if user is not None:
-            user.messages += 1
-            session.commit()
-        else:
-            user = User(id=data["user_id"], joins=1, messages=1)
-            session.add(user)
-            session.commit()
+        if self.logger.isEnabledFor(INFO):
+            bot_name = self.config["auth"]["username"]
+            meta = data["message"]["meta"]
+            self.logger.info(
+                "%s%s[%s] %s",
+                '$ ' if data["user_name"] == bot_name else '',
+                '*' if meta.get("me") else '',
+                data["user_name"] + " > " + bot_name
+                if meta.get("whisper") else data["user_name"],
+                parsed)
+
+        self.stats.record("messages")
+
+        user = self.users.get(data["user_id"])
+        self.points.seen(user.id)
+        if user.new and not user.joins:
+            self.users.increment(user, "joins")
+        self.users.increment(user, "messages")
 
         mod_roles = ("Owner", "Staff", "Founder", "Global Mod", "Mod")
         if not (data["user_roles"][0] in mod_roles or user.friend):
-            if (len(parsed) > self.config["spam_protection"].get(
-                    "maximum_message_length", 256)):
-                self.remove_message(data["channel"], data["id"])
-                user.offenses += 1
-                session.commit()
-                return self.send_message(
-                    data["user_name"], "Please stop spamming.",
-                    method="whisper")
-            elif (sum(char.isupper() for char in parsed) >
-                    self.config["spam_protection"].get(
-                        "maximum_message_capitals", 32)):
-                self.remove_message(data["channel"], data["id"])
-                user.offenses += 1
-                session.commit()
+            violation = self.spam_filter.check(data["message"]["message"])
+            if violation is not None:
+                spam_removals.inc(violation)
+                self.stats.record("spam_removals")
+                yield self._remove_message(data)
+                self.users.increment(user, "offenses")
                 return self.send_message(
-                    data["user_name"], "Please stop speaking in all caps.",
-                    method="whisper")
-            elif (sum(chunk["type"] == "emoticon"
-                      for chunk in data["message"]["message"]) >
-                    self.config["spam_protection"].get(
-                    "maximum_message_emotes", 8)):
-                self.remove_message(data["channel"], data["id"])
-                user.offenses += 1
-                session.commit()
-                return self.send_message(
-                    data["user_name"], "Please stop spamming emoticons.",
-                    method="whisper")
-            elif (findall(("http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|"
-                           "[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"),
-                          parsed) and not
-                    self.config["spam_protection"].get(
-                        "allow_links", False)):
-                self.remove_message(data["channel"], data["id"])
-                user.offenses += 1
-                session.commit()
-                return self.send_message(
-                    data["user_name"], "Please stop posting links.",
+                    data["user_name"], self.spam_filter.responses[violation],
                     method="whisper")
 
         if parsed == "/cry":
-            self.remove_message(data["channel"], data["id"])
+            yield self._remove_message(data)
             return self.send_message("/me cries with {} :'(".format(
                 data["user_name"]))
 
@@ -132,11 +170,15 @@ class MessageHandler(Beam):
             args = parsed.split()
 
             if args[0][1:] in self.commands:
+                commands.inc(args[0][1:])
+                self.stats.record("commands")
                 response = self.commands[args[0][1:]]
                 if isinstance(response, str):
                     messages = response
                 else:
                     messages = response(args, data)
+                    if is_future(messages):
+                        messages = yield messages
             else:
                 options = [
                     ('-'.join(args[:2])[1:], ['-'.join(args[:2])] + args[2:]),
@@ -144,9 +186,10 @@ class MessageHandler(Beam):
                 ]
 
                 for parse_method in options:
-                    command = session.query(
-                        Command).filter_by(command=parse_method[0]).first()
+                    command = self.command_index.get(parse_method[0])
                     if command:
+                        commands.inc(parse_method[0])
+                        self.stats.record("commands")
                         messages = command(
                             parse_method[1], data,
                             channel_name=self.channel_data["token"]
@@ -165,32 +208,60 @@ class MessageHandler(Beam):
             else:
                 self.send_message(*messages)
 
-    def join_handler(self, data):
-        """Handle user join packets from Beam."""
+    def handle_liveloading(self, packet):
+        """Handle liveloading packets, recording stream statistics."""
+
+        super(MessageHandler, self).handle_liveloading(packet)
+
+        if not (isinstance(packet["data"], list) and
+                isinstance(packet["data"][0], str)):
+            return
 
-        user = session.query(User).filter_by(id=data["id"]).first()
+        event, data = packet["data"][:2]
+        if data.get("following"):
+            self.stats.record("follows")
+        elif data.get("subscribed"):
+            self.stats.record("subscriptions")
+        elif event.startswith("channel:") and event.endswith(":update"):
+            if "viewersCurrent" in data:
+                self.stats.viewers(data["viewersCurrent"])
+            if "online" in data:
+                IOLoop.current().spawn_callback(self.update_stream)
 
-        if not user:
-            user = User(id=data["id"], joins=1)
+    @coroutine
+    def update_stream(self, restarted=False):
+        """Track the stream the channel is live with, if any.
+
+        After a restart, a stream that has since ended is taken to have
+        ended by its last snapshot.
+        """
+
+        manifest = yield self.get_manifest(
+            self.channel_data["id"], refresh=True)
+        if manifest.get("since") is not None:
+            self.stats.begin(manifest["since"])
+        elif restarted and self.stats.current is not None:
+            self.stats.end(self.stats.current["updated"])
         else:
-            session.add(user)
-            user.joins += 1
-        session.commit()
+            self.stats.end()
 
-        self.logger.info("- {user} joined".format(
-            user=data["username"]))
+    def join_handler(self, data):
+        """Handle user join packets from Beam."""
 
-        if self.config.get("announce_enter", False):
-            self.send_message("Welcome, @{username}!".format(
-                username=data["username"]))
+        self.users.join(data["id"])
+        self.points.join(data["id"])
+
+        self.logger.info("- %s joined", data["username"])
+
+        self.announcer.announce("enter", data["username"])
 
     def leave_handler(self, data):
         """Handle user leave packets from Beam."""
 
+        self.users.leave(data["id"])
+        self.points.leave(data["id"])
+
         if data["username"] is not None:
-            self.logger.info("- {user} left".format(
-                user=data["username"]))
+            self.logger.info("- %s left", data["username"])
 
-            if self.config.get("announce_leave", False):
-                self.send_message("See you, @{username}!".format(
-                    username=data["username"]))
+            self.announcer.announce("leave", data["username"])
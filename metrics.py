@@ -0,0 +1,241 @@
+from tornado.web import Application, RequestHandler
+
+from bisect import bisect_left
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    """Labelled metric in the Prometheus text format."""
+
+    type = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = dict()
+        (registry or default_registry).register(self)
+
+    def _labels(self, values, extra=()):
+        pairs = tuple(zip(self.labels, values)) + tuple(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(key, escape(value)) for key, value in pairs
+        ) + '}'
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name + self._labels(labels), value
+
+    @staticmethod
+    def combine(total, value):
+        return value if total is None else total + value
+
+    def forget(self, label, value):
+        """Drop values whose label has the given value."""
+
+        if label not in self.labels:
+            return
+        index = self.labels.index(label)
+        self.values = {
+            labels: sample for labels, sample in self.values.items()
+            if labels[index] != value
+        }
+
+    def expose(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type)
+        ]
+        lines.extend(
+            "{} {}".format(sample, repr(float(value)))
+            for sample, value in self.samples()
+        )
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    buckets = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1, 2.5, 5, 10
+    )
+
+    def observe(self, value, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def combine(total, value):
+        if total is None:
+            return list(value)
+        return [first + second for first, second in zip(total, value)]
+
+    def samples(self):
+        for labels, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield self.name + "_bucket" + self._labels(
+                    labels, (("le", bound),)), total
+            yield self.name + "_sum" + self._labels(labels), counts[-1]
+            yield self.name + "_count" + self._labels(labels), total
+
+
+class Registry:
+    """Collection of metrics."""
+
+    def __init__(self):
+        self.metrics = list()
+        self.collectors = list()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        """Call a function to update metrics before they are exposed."""
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        """Stop calling a collector, if it was added."""
+
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def forget(self, label, value):
+        """Drop gauge values labelled with a value, like a removed channel."""
+
+        for metric in self.metrics:
+            if isinstance(metric, Gauge):
+                metric.forget(label, value)
+
+    def snapshot(self):
+        """Get the values of every metric, to be combined elsewhere."""
+
+        for collector in self.collectors:
+            collector()
+        return {metric.name: dict(metric.values) for metric in self.metrics}
+
+    def combine(self, snapshots):
+        """Set every metric to the total of snapshots from other processes."""
+
+        for metric in self.metrics:
+            metric.values = dict()
+            for snapshot in snapshots:
+                for labels, value in snapshot.get(metric.name, {}).items():
+                    metric.values[labels] = metric.combine(
+                        metric.values.get(labels), value)
+
+    def expose(self):
+        """Get every metric in the Prometheus text format."""
+
+        for collector in self.collectors:
+            collector()
+        return '\n'.join(metric.expose() for metric in self.metrics) + '\n'
+
+
+default_registry = Registry()
+
+chat_events = Counter(
+    "cactusbot_chat_events_total", "Chat events received.", ("event",))
+handler_latency = Histogram(
+    "cactusbot_handler_seconds", "Time spent handling chat events.",
+    ("handler",))
+commands = Counter(
+    "cactusbot_commands_total", "Commands executed.", ("command",))
+spam_removals = Counter(
+    "cactusbot_spam_removals_total", "Messages removed as spam.", ("rule",))
+spam_evaluations = Gauge(
+    "cactusbot_spam_evaluations", "Messages checked by the spam filter.",
+    ("channel",))
+spam_evaluation_time = Gauge(
+    "cactusbot_spam_evaluation_seconds",
+    "Time spent checking messages for spam.", ("channel",))
+spam_hits = Gauge(
+    "cactusbot_spam_hits", "Messages caught by each spam rule.",
+    ("channel", "rule"))
+outbound_depth = Gauge(
+    "cactusbot_outbound_queue_depth", "Packets waiting to be sent.",
+    ("channel",))
+outbound_wait = Gauge(
+    "cactusbot_outbound_wait_seconds_max",
+    "Longest time a packet waited to be sent.", ("channel",))
+rest_latency = Histogram(
+    "cactusbot_rest_seconds", "Beam REST call latency.", ("endpoint",))
+cache_lookups = Gauge(
+    "cactusbot_cache_lookups", "Beam REST cache lookups.", ("result",))
+database_flushes = Histogram(
+    "cactusbot_database_flush_seconds", "Time spent writing batched changes.",
+    ("store",))
+presence_events = Counter(
+    "cactusbot_presence_events_total",
+    "User joins and leaves, including merged reconnects.", ("event",))
+reconnects = Counter(
+    "cactusbot_websocket_reconnects_total", "Websocket reconnections.",
+    ("websocket",))
+liveloading_dead_time = Gauge(
+    "cactusbot_liveloading_dead_seconds",
+    "Time spent disconnected from liveloading.", ("channel",))
+cached_users = Gauge(
+    "cactusbot_cached_users", "Users held in memory.", ("channel",))
+present_viewers = Gauge(
+    "cactusbot_present_viewers", "Viewers earning points.", ("channel",))
+orm_objects = Gauge(
+    "cactusbot_orm_objects", "Objects held by the database session.",
+    ("channel", "model"))
+memory_entries = Gauge(
+    "cactusbot_memory_entries", "Entries held by in-memory structures.",
+    ("channel", "structure"))
+stalls = Gauge(
+    "cactusbot_ioloop_stalls", "Times the IOLoop was blocked.")
+stall_time = Gauge(
+    "cactusbot_ioloop_stall_seconds", "Time the IOLoop was blocked.")
+channel_rate = Gauge(
+    "cactusbot_channel_events_per_second", "Chat events per second.",
+    ("channel",))
+worker_restarts = Gauge(
+    "cactusbot_worker_restarts", "Times a worker process was restarted.",
+    ("worker",))
+
+
+class MetricsHandler(RequestHandler):
+
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(self.registry.expose())
+
+
+def start_server(port=9100, address='', registry=None):
+    """Serve metrics over HTTP."""
+
+    application = Application([
+        (r"/metrics", MetricsHandler,
+         {"registry": registry or default_registry})
+    ])
+    return application.listen(port, address=address)
@@ -1,23 +1,101 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, bindparam
+from sqlalchemy.event import listen
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey
-from sqlalchemy.orm import Session, relationship
+from sqlalchemy.orm import Session, relationship, validates
 from sqlalchemy.ext.declarative import declarative_base
 
+from logging import getLogger as get_logger
 from functools import wraps, partial
+from contextlib import contextmanager
+from collections import Counter
 
 from os.path import abspath, dirname, join
 from datetime import datetime
+from time import monotonic
 
-from re import sub, findall, match
+from re import sub, findall, match, compile
 from random import randrange, choice
 
-from tornado.ioloop import PeriodicCallback
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.gen import coroutine
+
+from metrics import database_flushes
+
+default_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -16000,
+    "busy_timeout": 5000
+}
+
+
+def set_pragmas(pragmas, connection, record):
+    cursor = connection.cursor()
+    for name, value in pragmas.items():
+        if not name.isidentifier():
+            raise ValueError("Invalid SQLite pragma '{}'.".format(name))
+        cursor.execute("PRAGMA {} = {}".format(name, value))
+    cursor.close()
+
+
+def create_database_engine(database, pragmas=None):
+    """Create an engine for a SQLite database file, setting pragmas.
+
+    The pragmas override default_pragmas, and are set on every new
+    connection.
+    """
+
+    database_engine = create_engine("sqlite:///" + database)
+    listen(database_engine, "connect", partial(
+        set_pragmas, dict(default_pragmas, **(pragmas or dict()))))
+    return database_engine
+
 
 basedir = abspath(dirname(__file__))
-engine = create_engine("sqlite:///" + join(basedir, "data/data.db"))
+engine = create_database_engine(join(basedir, "data/data.db"))
 Base = declarative_base()
 
-session = Session(engine)
+session = Session(engine, expire_on_commit=False)
+
+
+def bind(database, pragmas=None):
+    """Use a different SQLite database file."""
+
+    global engine
+    engine = create_database_engine(database, pragmas)
+    session.bind = engine
+    return engine
+
+
+def create_session(database, pragmas=None):
+    """Open a separate session on a SQLite database file."""
+
+    channel_engine = create_database_engine(database, pragmas)
+    Base.metadata.create_all(channel_engine)
+    return Session(channel_engine, expire_on_commit=False)
+
+
+@contextmanager
+def session_scope(bind):
+    """Open a short-lived session, committing when it is closed."""
+
+    scoped_session = Session(bind, expire_on_commit=False)
+    try:
+        yield scoped_session
+        scoped_session.commit()
+    except Exception:
+        scoped_session.rollback()
+        raise
+    finally:
+        scoped_session.close()
+
+
+def memory_report(session):
+    """Count the objects of each model held by a session."""
+
+    return Counter(
+        type(instance).__name__ for instance in session.identity_map.values())
 
 
 def role_specific(*roles, reply=None):
@@ -45,6 +123,52 @@ mod_roles = ("Founder", "Staff", "Global Mod", "Mod")
 mod_only = role_specific(*mod_roles, reply="mod")
 
 
+class Template:
+    """Command response parsed into literal and placeholder segments."""
+
+    expression = compile("%(name|args|count|channel|arg(\\d+))%")
+
+    def __init__(self, source):
+        self.source = source
+        self.segments = list()
+        self.arguments = 0
+
+        position = 0
+        for placeholder in self.expression.finditer(source):
+            if placeholder.start() > position:
+                self.segments.append(
+                    (source[position:placeholder.start()], None))
+
+            if placeholder.group(2) is not None:
+                index = int(placeholder.group(2))
+                self.arguments = max(self.arguments, index + 1)
+                self.segments.append((None, index))
+            else:
+                self.segments.append((None, placeholder.group(1)))
+
+            position = placeholder.end()
+
+        if position < len(source):
+            self.segments.append((source[position:], None))
+
+        self.placeholders = {
+            key for _, key in self.segments if isinstance(key, str)}
+
+    def render(self, args, **values):
+        """Fill placeholders from arguments and values."""
+
+        if "args" in self.placeholders:
+            values["args"] = ' '.join(args[1:])
+        values = {key: str(values[key]) for key in self.placeholders}
+
+        return ''.join([
+            literal if key is None
+            else args[key] if isinstance(key, int)
+            else values[key]
+            for literal, key in self.segments
+        ])
+
+
 class Command(Base):
     __tablename__ = "commands"
 
@@ -63,41 +187,40 @@ class Command(Base):
     repeat = relationship("Repeat", backref="command")
 
     def __call__(self, args, data, **kwargs):
+        if getattr(self, "_template", None) is None:
+            self._compile()
+        return self._run(self, args, data, **kwargs)
+
+    def _compile(self):
+        """Cache the permission check and parsed response."""
+
         if self.permissions:
             roles = str(self.permissions).split(',') + list(mod_roles)
         else:
             roles = all_roles
 
-        @role_specific(*roles)
-        def run_command(self, args, data, channel_name=None):
-            response = self.response
-
-            response = response.replace("%name%", data["user_name"])
+        self._run = role_specific(*roles)(Command._respond)
+        self._template = Template(self.response)
 
-            try:
-                response = sub(
-                    "%arg(\d+)%",
-                    lambda match: args[int(match.group(1))],
-                    response
-                )
-            except IndexError:
-                return "Not enough arguments!"
+    @validates("response", "permissions")
+    def _invalidate(self, key, value):
+        self._template = None
+        return value
 
-            response = response.replace("%args%", ' '.join(args[1:]))
-
-            self.calls += 1
-            session.commit()
-
-            response = response.replace("%count%", str(self.calls))
+    def _respond(self, args, data, channel_name=None):
+        if len(args) < self._template.arguments:
+            return "Not enough arguments!"
 
-            response = response.replace(
-                "%channel%",
-                channel_name if channel_name else data["id"]
-            )
+        self.calls = (self.calls or 0) + 1
 
-            return response.split('\\n', 2)
+        response = self._template.render(
+            args,
+            name=data["user_name"],
+            count=self.calls,
+            channel=channel_name if channel_name else data["id"]
+        )
 
-        return run_command(self, args, data, **kwargs)
+        return response.split('\\n', 2)
 
 
 class Repeat(Base):
@@ -138,9 +261,154 @@ class User(Base):
     points = Column(Integer, default=0)
 
 
+class CommandIndex:
+    """In-memory index of custom commands by name.
+
+    Commands are loaded once and detached from the session. Changes to
+    them, and their call counts, are written on the database writer's
+    thread, keyed by name, since a new command has no id until its insert
+    has run.
+    """
+
+    def __init__(self, session, writer, interval=10):
+        self.session = session
+        self.writer = writer
+        self.interval = interval
+
+        self.logger = get_logger("CactusBot")
+
+        self.commands = dict()
+        self.saved_calls = dict()
+        self.flusher = None
+
+        self.table = Command.__table__
+        self.calls_statement = self.table.update().where(
+            self.table.c.command == bindparam("command_name")
+        ).values(calls=bindparam("calls_value"))
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def __iter__(self):
+        return iter(self.commands.values())
+
+    def load(self):
+        """Load every custom command from the database."""
+
+        commands = self.session.query(Command).all()
+        for command in commands:
+            self.session.expunge(command)
+        self.session.commit()
+
+        self.commands = {
+            command.command: command for command in commands
+            if command.command
+        }
+        self.saved_calls = {
+            command.command: command.calls or 0 for command in commands}
+
+    def get(self, name):
+        """Get a custom command by name."""
+        return self.commands.get(name)
+
+    def add(self, command):
+        """Add or replace a custom command."""
+        self.commands[command.command] = command
+
+    def remove(self, name):
+        """Remove a custom command."""
+        self.commands.pop(name, None)
+
+    @coroutine
+    def save(self, command):
+        """Add or replace a custom command, and write it."""
+
+        self.add(command)
+        values = {
+            column: getattr(command, column)
+            for column in ("command", "response", "permissions", "calls",
+                           "creation", "author")
+        }
+        self.saved_calls[command.command] = values["calls"] or 0
+        yield self.writer.run(self._save, values)
+
+    def _save(self, session, values):
+        updated = session.execute(
+            self.table.update().where(
+                self.table.c.command == values["command"]
+            ).values(**values)
+        ).rowcount
+        if not updated:
+            session.execute(self.table.insert().values(**values))
+
+    def delete(self, command):
+        """Remove a custom command, and delete it from the database."""
+
+        self.remove(command.command)
+        self.saved_calls.pop(command.command, None)
+        return self.writer.run(self._delete, command.command)
+
+    def _delete(self, session, name):
+        session.execute(
+            self.table.delete().where(self.table.c.command == name))
+
+    def start(self):
+        """Start saving call counts periodically."""
+
+        if self.flusher is None:
+            self.flusher = PeriodicCallback(self.flush, self.interval * 1000)
+            self.flusher.start()
+
+    def stop(self):
+        """Stop saving periodically, and save remaining call counts."""
+
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher = None
+
+        future = self.flush()
+        if future is not None:
+            future.result()
+
+    def flush(self):
+        """Save call counts of used commands in a single transaction."""
+
+        changes = list()
+        for command in self.commands.values():
+            calls = command.calls or 0
+            if calls != self.saved_calls.get(command.command):
+                changes.append(
+                    {"command_name": command.command, "calls_value": calls})
+                self.saved_calls[command.command] = calls
+
+        if not changes:
+            return None
+
+        future = self.writer.run(self._save_calls, changes)
+        IOLoop.current().add_future(
+            future, partial(self._flushed, monotonic(), len(changes)))
+        return future
+
+    def _save_calls(self, session, changes):
+        session.execute(self.calls_statement, changes)
+
+    def _flushed(self, started, count, future):
+        if future.exception() is not None:
+            self.logger.error(
+                "Failed to save call counts of %d commands.", count,
+                exc_info=future.exception())
+            return
+        database_flushes.observe(monotonic() - started, "commands")
+
+
 class CommandCommand(Command):
 
+    def __init__(self, index):
+        super(CommandCommand, self).__init__()
+        self.index = index
+
     @mod_only
+    @coroutine
     def __call__(self, args, data):
         if len(args) > 1:
             if args[1] == "add":
@@ -159,8 +427,7 @@ class CommandCommand(Command):
                     permissions = ','.join(
                         {symbols_to_permissions[symbol] for symbol in symbols})
 
-                    command = session.query(Command).filter_by(
-                        command=name).first()
+                    command = self.index.get(name)
 
                     if command:
                         command.permissions = permissions
@@ -174,24 +441,19 @@ class CommandCommand(Command):
                             author=data["user_id"]
                         )
 
-                    session.add(command)
-                    session.commit()
+                    yield self.index.save(command)
                     return "Added command !{}.".format(name)
                 return "Not enough arguments!"
             elif args[1] == "remove":
                 if len(args) > 2:
-                    command = session.query(Command).filter_by(
-                        command=args[2]).first()
+                    command = self.index.get(args[2])
                     if command is not None:
-                        session.delete(command)
-                        session.commit()
+                        yield self.index.delete(command)
                         return "Removed command !{}.".format(args[2])
                     return "!{} does not exist!".format(args[2])
                 return "Not enough arguments!"
             elif args[1] == "list":
-                commands = session.query(Command).all()
-                commands_list = ', '.join(
-                    [c.command for c in commands if c.command])
+                commands_list = ', '.join(c.command for c in self.index)
                 if commands_list:
                     return "Commands: {commands}.".format(
                         commands=commands_list)
@@ -202,8 +464,16 @@ class CommandCommand(Command):
 
 class QuoteCommand(Command):
 
+    def __init__(self, writer):
+        super(QuoteCommand, self).__init__()
+        self.writer = writer
+
     @mod_only
+    @coroutine
     def __call__(self, args, data):
+        return (yield self.writer.run(self._quote, args, data))
+
+    def _quote(self, session, args, data):
         if len(args) > 1:
             try:
                 id = int(args[1])
@@ -250,10 +520,11 @@ class SocialCommand(Command):
         super(SocialCommand, self).__init__()
         self.get_channel = get_channel
 
+    @coroutine
     def __call__(self, args, data=None):
-        channel_data = self.get_channel(data["channel"])
+        channel_data = yield self.get_channel(data["channel"])
         name = channel_data["token"]
-        s = channel_data["user"]["social"]
+        s = dict(channel_data["user"]["social"] or {})
         a = [arg.lower() for arg in args[1:]]
         if s:
             if not a:
@@ -294,13 +565,13 @@ class CubeCommand(Command):
 
 class UptimeCommand(Command):
 
-    def __init__(self, request):
+    def __init__(self, get_manifest):
         super(UptimeCommand, self).__init__()
-        self.request = request
+        self.get_manifest = get_manifest
 
+    @coroutine
     def __call__(self, args, data):
-        response = self.request(
-            "/channels/{id}/manifest.light".format(id=data["channel"]))
+        response = yield self.get_manifest(data["channel"])
         if response.get("since") is not None:
             return "Channel has been live for {}.".format(
                 match(
@@ -313,39 +584,153 @@ class UptimeCommand(Command):
 
 class PointsCommand(Command):
 
-    def __init__(self, points_name):
+    def __init__(self, points_name, users):
         super(PointsCommand, self).__init__()
         self.points_name = points_name
+        self.users = users
 
     def __call__(self, args, data):
         if len(args) > 1:
             return "Points update in development. :cactus"
-        user = session.query(User).filter_by(id=data["user_id"]).first()
+        user = self.users.get(data["user_id"])
         return "@{user} has {amount} {name}.".format(
             user=data["user_name"],
             amount=user.points,
             name=self.points_name + ('s' if user.points != 1 else ''))
 
 
+def ranking_field(args, points_name):
+    """Get the leaderboard field named by command arguments."""
+
+    if not args or args[0].lower() in (
+            "points", points_name, points_name + 's'):
+        return "points"
+    if args[0].lower() in ("messages", "chatters"):
+        return "messages"
+    return None
+
+
+class TopCommand(Command):
+
+    def __init__(self, points_name, leaderboard, get_user, count=5):
+        super(TopCommand, self).__init__()
+        self.points_name = points_name
+        self.leaderboard = leaderboard
+        self.get_user = get_user
+        self.count = count
+
+    @coroutine
+    def __call__(self, args, data=None):
+        field = ranking_field(args[1:], self.points_name)
+        if field is None:
+            return "Rankings are by {}s or messages.".format(self.points_name)
+
+        top = self.leaderboard.top(field, self.count)
+        if not top:
+            return "Nobody is ranked yet."
+
+        users = yield [self.get_user(id) for id, value in top]
+        return "Top {}: {}.".format(
+            self.points_name + 's' if field == "points" else "chatters",
+            ', '.join(
+                "{}. @{} ({})".format(
+                    index, user.get("username", id), value)
+                for index, ((id, value), user) in enumerate(
+                    zip(top, users), start=1)))
+
+
+class RankCommand(Command):
+
+    def __init__(self, points_name, leaderboard):
+        super(RankCommand, self).__init__()
+        self.points_name = points_name
+        self.leaderboard = leaderboard
+
+    def __call__(self, args, data):
+        field = ranking_field(args[1:], self.points_name)
+        if field is None:
+            return "Rankings are by {}s or messages.".format(self.points_name)
+
+        ranked = self.leaderboard.rank(field, data["user_id"])
+        if ranked is None:
+            return "@{} is not ranked yet.".format(data["user_name"])
+
+        rank, value = ranked
+        name = self.points_name if field == "points" else "message"
+        return "@{} is ranked #{} of {} with {} {}.".format(
+            data["user_name"], rank, self.leaderboard.ranked(field), value,
+            name + ('s' if value != 1 else ''))
+
+
+class StatsCommand(Command):
+
+    summary = (
+        "{messages} messages, {commands} commands, {follows} follows, "
+        "{subscriptions} subscriptions, {spam_removals} spam removals and "
+        "a peak of {peak_viewers} viewers"
+    )
+
+    def __init__(self, stats):
+        super(StatsCommand, self).__init__()
+        self.stats = stats
+
+    def __call__(self, args, data=None):
+        if len(args) > 1 and args[1] == "total":
+            summary = self.stats.summary()
+            return "Over {} streams: {}.".format(
+                summary["streams"], self.summary.format(**summary))
+
+        recent = self.stats.recent(1)
+        if not recent:
+            return "No streams have been recorded yet."
+        return "{} stream: {}.".format(
+            "This" if recent[0]["ended"] is None else "Last",
+            self.summary.format(**recent[0]))
+
+
 class RepeatCommand(Command):
 
-    def __init__(self, send_message, bot_name, channel):
+    def __init__(self, send_message, bot_name, channel, index):
         super(RepeatCommand, self).__init__()
         self.send_message = send_message
         self.data = {"user_name": bot_name, "user_roles": all_roles}
         self.channel = channel
+        self.index = index
+        self.writer = index.writer
 
         self.repeats = dict()
+        self.settings = dict()
 
-        for repeat in session.query(Repeat).all():
-            periodic_callback = PeriodicCallback(
-                partial(self.send, repeat),
-                repeat.interval * 1000
-            )
-            self.repeats[repeat.command.command] = periodic_callback
-            periodic_callback.start()
+        repeats = index.session.query(
+            Repeat.command_name, Repeat.interval, Repeat.arguments).all()
+        index.session.commit()
+
+        for name, interval, arguments in repeats:
+            self._start(name, interval, arguments)
+
+    def _start(self, name, interval, arguments):
+        if name in self.repeats:
+            self.repeats[name].stop()
+
+        periodic_callback = PeriodicCallback(
+            partial(self.send, name), interval * 1000)
+        periodic_callback.start()
+
+        self.repeats[name] = periodic_callback
+        self.settings[name] = (interval, arguments)
+
+    def _stop(self, name):
+        self.repeats.pop(name).stop()
+        del self.settings[name]
+
+    def stop(self):
+        """Stop every repeat."""
+
+        for periodic_callback in self.repeats.values():
+            periodic_callback.stop()
 
     @mod_only
+    @coroutine
     def __call__(self, args, data):
         if args[1] == "add":
             if len(args) > 3:
@@ -354,77 +739,68 @@ class RepeatCommand(Command):
                 except ValueError:
                     return "Invalid interval: '{}'.".format(args[2])
 
-                repeat = session.query(Repeat).filter_by(
-                    command_name=args[3]).first()
-
-                if repeat:
-                    repeat.interval = interval
-                    repeat.arguments = ' '.join(args[3:])
-                    periodic_callback = self.repeats[repeat.command.command]
-                    periodic_callback.callback_time = interval * 1000
-                    periodic_callback.stop()
-                    periodic_callback.start()
-                    session.add(repeat)
-                    session.commit()
-                    return "Repeat updated."
+                name = args[3]
+                arguments = ' '.join(args[3:])
+                updated = name in self.repeats
 
-                command = session.query(Command).filter_by(command=args[3])
-                if command.first():
-                    command = command.first()
-                    repeat = Repeat(
-                        command_object=command,
-                        interval=interval,
-                        arguments=' '.join(args[3:])
-                    )
+                if not updated and name not in self.index:
+                    return "Undefined command '!{}'.".format(name)
 
-                    periodic_callback = PeriodicCallback(
-                        partial(self.send, repeat),
-                        interval * 1000
-                    )
-                    self.repeats[args[3]] = periodic_callback
-                    periodic_callback.start()
-                    session.add(repeat)
-                    session.commit()
-                    return "Repeating command '!{}' every {} seconds.".format(
-                        command.command, interval)
-                return "Undefined command '!{}'.".format(args[3])
+                self._start(name, interval, arguments)
+                yield self.writer.run(
+                    self._save, name, interval, arguments)
+
+                if updated:
+                    return "Repeat updated."
+                return "Repeating command '!{}' every {} seconds.".format(
+                    name, interval)
             return "Not enough arguments!"
         elif args[1] == "remove":
             if len(args) > 2:
-                repeat = session.query(Repeat).filter_by(
-                    command_name=args[2]).first()
-                if repeat is not None:
-                    self.repeats[args[2]].stop()
-                    del self.repeats[args[2]]
-                    session.delete(repeat)
-                    session.commit()
+                if args[2] in self.repeats:
+                    self._stop(args[2])
+                    yield self.writer.run(self._delete, args[2])
                     return "Removed repeat for command !{}.".format(args[2])
                 return "Repeat for !{} does not exist!".format(args[2])
             return "Not enough arguments!"
         elif args[1] == "list":
-            repeats = session.query(Repeat).all()
             return "Repeats: {repeats}".format(
                 repeats=', '.join(
-                    [r.command.command+' '+str(r.interval) for r in repeats]
+                    name + ' ' + str(interval)
+                    for name, (interval, _) in self.settings.items()
                 )
             )
         return "Invalid argument: {}.".format(args[1])
 
-    def send(self, repeat):
-        try:
-            self.send_message(
-                repeat.command(
-                    repeat.arguments.split(),
-                    self.data,
-                    channel_name=self.channel
-                )
-            )
-        except TypeError:
-            command_name = repeat.command_name
-            self.repeats[command_name].stop()
-            del self.repeats[command_name]
-            session.delete(repeat)
-            session.commit()
+    @staticmethod
+    def _save(session, name, interval, arguments):
+        table = Repeat.__table__
+        updated = session.execute(
+            table.update().where(table.c.command_name == name).values(
+                interval=interval, arguments=arguments)
+        ).rowcount
+        if not updated:
+            session.execute(table.insert().values(
+                command_name=name, interval=interval, arguments=arguments))
+
+    @staticmethod
+    def _delete(session, name):
+        table = Repeat.__table__
+        session.execute(table.delete().where(table.c.command_name == name))
+
+    def send(self, name):
+        command = self.index.get(name)
+        if command is None:
+            self._stop(name)
+            self.writer.run(self._delete, name)
+            return
+
+        interval, arguments = self.settings[name]
+        messages = command(
+            arguments.split(), self.data, channel_name=self.channel)
+        if isinstance(messages, str):
+            messages = (messages,)
+        self.send_message(*messages)
 
 
 class TemmieCommand(Command):
@@ -445,20 +821,22 @@ class TemmieCommand(Command):
 
 class FriendCommand(Command):
 
-    def __init__(self, get_channel):
+    def __init__(self, get_channel, users):
         super(FriendCommand, self).__init__()
         self.get_channel = get_channel
+        self.users = users
 
     @mod_only
+    @coroutine
     def __call__(self, args, data):
         if len(args) == 2:
-            id = self.get_channel(args[1])["user"]["id"]
-            query = session.query(User).filter_by(id=id).first()
-            if query:
-                query.friend = not query.friend
-                session.commit()
+            channel_data = yield self.get_channel(args[1])
+            id = channel_data["user"]["id"]
+            user = self.users.get(id, create=False)
+            if user:
+                self.users.set_friend(user, not user.friend)
                 return "{}ed @{} as a friend.".format(
-                    ["Remov", "Add"][query.friend], args[1])
+                    ["Remov", "Add"][user.friend], args[1])
             else:
                 return "User has not entered this channel."
         elif len(args) > 2:
@@ -0,0 +1,199 @@
+# Run CactusBot in many Beam channels from one process.
+#
+# The configuration file has the usual keys, plus a "channels" object. Each
+# channel may override any top-level key, and may set its own "database":
+#
+#     "channels": {
+#         "CactusBot": {},
+#         "Innectic": {"spam_protection": {"allow_links": true}}
+#     }
+
+from cactus import Cactus, cactus_art, init_monitoring
+from beam import Beam
+from models import create_session
+import metrics
+
+from tornado.gen import coroutine, sleep
+from tornado.ioloop import IOLoop
+
+from json import load
+from os.path import exists
+from functools import partial
+
+from sys import exit
+from traceback import format_exc
+
+from argparse import ArgumentParser
+
+
+class MultiChannel(Beam):
+    """Many channels sharing one IOLoop, HTTP client, login and cache."""
+
+    def __init__(self, config_file="data/config.json", debug="info",
+                 **kwargs):
+        super(MultiChannel, self).__init__(debug, **kwargs)
+
+        self.config_file = config_file
+        self.silent = kwargs.get("silent", False)
+        self.serve_metrics = kwargs.get("serve_metrics", True)
+
+        self.channels = dict()
+
+    def load_config(self, filename):
+        """Load configuration file."""
+
+        if not exists(filename):
+            raise FileNotFoundError("Configuration file not found.")
+
+        with open(filename) as config:
+            self.config = load(config)
+
+        if not self.config.get("channels"):
+            raise KeyError("No channels are configured.")
+
+        return self.config
+
+    def add_channel(self, name):
+        """Create a bot for a channel, and start it."""
+
+        bot = Cactus(
+            config_file=self.config_file,
+            config_section=name,
+            logger=self.logger.getChild(name),
+            api=self.path,
+            liveloading=self.liveloading_path,
+            cookies=self.cookies,
+            cache=self.cache,
+            session=create_session(
+                self.config["channels"][name].get(
+                    "database", "data/{}.db".format(name)),
+                self.config.get("sqlite")),
+            stats_file=self.config["channels"][name].get(
+                "stats", "data/{}.stats.jsonl".format(name)),
+            silent=self.silent
+        )
+        bot.load_config(self.config_file)
+        bot.load_stats(bot.stats_file)
+
+        self.channels[name] = bot
+        IOLoop.current().add_callback(self.start_channel, bot)
+
+        return bot
+
+    def remove_channel(self, name):
+        """Stop and disconnect a channel's bot."""
+
+        bot = self.channels.pop(name)
+        bot.stop()
+        bot.disconnect()
+        bot.writer.shutdown()
+        bot.session.close()
+
+        metrics.default_registry.remove_collector(bot._collect_metrics)
+        metrics.default_registry.forget("channel", name)
+
+    @coroutine
+    def start_channel(self, bot):
+        """Start a channel's bot, retrying if autorestart is enabled.
+
+        Retrying stops once the channel is removed.
+        """
+
+        while self.channels.get(bot.config_section) is bot:
+            try:
+                yield bot.start(self.bot_data)
+                return
+            except Exception:
+                bot.logger.critical("Failed to join channel.")
+                bot.logger.error('\n\n' + format_exc())
+
+                if not bot.config.get("autorestart"):
+                    return
+
+                bot.logger.info("Retrying in 10 seconds...")
+                yield sleep(10)
+
+    def stop(self, message=None):
+        """Stop every channel's bot."""
+
+        for name, bot in self.channels.items():
+            try:
+                bot.stop(message)
+            except Exception:
+                bot.logger.error("Failed to save users and commands.")
+
+    def run(self, channels=None):
+        """Run bots in the given channels, or every configured channel."""
+
+        self.logger.info(cactus_art)
+        self.load_config(self.config_file)
+
+        if channels is None:
+            channels = self.config["channels"]
+
+        self.stall_detector = init_monitoring(
+            self.config, self.cache, self.serve_metrics)
+
+        loop = IOLoop.current()
+
+        self.bot_data = loop.run_sync(
+            partial(self.login, **self.config["auth"]))
+        self.logger.info("Authenticated as: {}.".format(
+            self.bot_data["username"]))
+
+        for name in sorted(channels):
+            self.add_channel(name)
+
+        try:
+            loop.start()
+        except KeyboardInterrupt:
+            print()
+            self.logger.info("Removing thorns... done.")
+            try:
+                self.stop("CactusBot deactivated! :cactus")
+            finally:
+                exit()
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description="Run CactusBot in many channels from one process.")
+
+    parser.add_argument(
+        "--config",
+        help="configuration file with a \"channels\" object",
+        dest="config_file",
+        default="data/config.json"
+    )
+
+    parser.add_argument(
+        "--silent",
+        help="send no messages to chat",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--debug",
+        help="set custom logger level",
+        nargs='?',
+        const=True,
+        default="info"
+    )
+
+    parser.add_argument(
+        "--api",
+        help="use a custom Beam API URL",
+        default=None
+    )
+
+    parser.add_argument(
+        "--liveloading",
+        help="use a custom Beam liveloading websocket URL",
+        default=None
+    )
+
+    parsed = parser.parse_args()
+
+    MultiChannel(**parsed.__dict__).run()
@@ -0,0 +1,174 @@
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+
+from collections import deque
+from time import monotonic
+
+
+class MessageQueue:
+    """Rate-limited queue of outbound chat packets.
+
+    Packets are released by a token bucket. Whispers and moderation
+    packets jump ahead of chat messages. When chat messages cannot be sent
+    yet, adjacent ones from different replies are merged while they still
+    fit in a single message. Sending pauses while the websocket is closed.
+    """
+
+    priorities = {
+        "whisper": 0,
+        "timeout": 0,
+        "purge": 0,
+        "deleteMessage": 0,
+        "clearMessages": 0
+    }
+    default_priority = 1
+
+    def __init__(self, write, rate=2, burst=10, max_length=360):
+        self.write = write
+
+        self.rate = rate
+        self.burst = burst
+        self.max_length = max_length
+
+        self.tokens = burst
+        self.updated = monotonic()
+
+        self.lanes = tuple(deque() for _ in range(self.default_priority + 1))
+        self.scheduled = False
+        self.paused = False
+
+        self.sent = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def put(self, method, arguments, reply=None):
+        """Queue a method packet for sending.
+
+        Lines of the same reply, which share a reply token, are never merged
+        into one message.
+        """
+
+        lane = self.lanes[self.priorities.get(method, self.default_priority)]
+
+        if method == "msg" and lane and self._backlogged():
+            if self._merge(lane[-1], arguments[0], reply):
+                self.coalesced += 1
+                return
+
+        lane.append([method, arguments, monotonic(), {reply}])
+        self.max_depth = max(self.max_depth, len(self))
+        self._schedule(0)
+
+    def _backlogged(self):
+        """Check whether another packet would have to wait to be sent."""
+
+        if self.paused:
+            return True
+        self._refill()
+        return len(self) + 1 > self.tokens
+
+    def _merge(self, packet, message, reply):
+        """Append a chat message to a queued one, if it fits."""
+
+        if packet[0] != "msg":
+            return False
+        if reply is not None and reply in packet[3]:
+            return False
+
+        queued = packet[1][0]
+        if queued.startswith('/') or message.startswith('/'):
+            return False
+
+        merged = queued + ' ' + message
+        if len(merged) > self.max_length:
+            return False
+
+        packet[1] = (merged,)
+        packet[3].add(reply)
+        return True
+
+    def pause(self):
+        """Stop sending until resumed, such as while reconnecting."""
+        self.paused = True
+
+    def resume(self):
+        """Send queued packets again."""
+
+        self.paused = False
+        if len(self):
+            self._schedule(0)
+
+    def _schedule(self, delay):
+        if not (self.scheduled or self.paused):
+            self.scheduled = True
+            IOLoop.current().call_later(delay, self._drain)
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _pop(self):
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+        return None
+
+    def _drain(self):
+        """Send queued packets while tokens are available."""
+
+        self.scheduled = False
+        if self.paused:
+            return
+        self._refill()
+
+        while self.tokens >= 1:
+            packet = self._pop()
+            if packet is None:
+                return
+            try:
+                self._send(packet)
+            except WebSocketClosedError:
+                self.lanes[self.priorities.get(
+                    packet[0], self.default_priority)].appendleft(packet)
+                self.pause()
+                return
+            self.tokens -= 1
+
+        if len(self):
+            self._schedule((1 - self.tokens) / self.rate)
+
+    def _send(self, packet):
+        method, arguments, queued = packet[:3]
+        self.write(method, arguments)
+
+        wait = monotonic() - queued
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.sent += 1
+
+    def flush(self):
+        """Send every queued packet immediately, ignoring the rate limit."""
+
+        packet = self._pop()
+        while packet is not None:
+            self._send(packet)
+            packet = self._pop()
+
+    def stats(self):
+        """Get queue depth and wait time statistics."""
+
+        return {
+            "depth": len(self),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "average_wait": self.total_wait / self.sent if self.sent else 0.0,
+            "max_wait": self.max_wait
+        }
@@ -0,0 +1,146 @@
+from models import User
+from metrics import database_flushes
+
+from sqlalchemy import bindparam
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from logging import getLogger as get_logger
+from functools import partial
+from time import monotonic
+
+
+class PointsEngine:
+    """Periodically award points to every viewer present in the channel.
+
+    Viewers are tracked from joins, leaves and chat activity. Each award is
+    written as one UPDATE executed for all present viewers, in a single
+    transaction; given a DatabaseWriter, it runs on its thread.
+    """
+
+    def __init__(self, users, writer=None, config=None):
+        self.users = users
+        self.writer = writer
+
+        self.logger = get_logger("CactusBot")
+
+        self.present = set()
+        self.awarder = None
+
+        self.awards = 0
+        self.awarded = 0
+
+        table = User.__table__
+        self.award_statement = table.update().where(
+            table.c.id == bindparam("user_id")
+        ).values(points=table.c.points + bindparam("amount"))
+
+        self.configure(config or dict())
+
+    def __len__(self):
+        return len(self.present)
+
+    def configure(self, config):
+        """Apply the points configuration, restarting the timer if needed."""
+
+        self.enabled = config.get("enabled", True)
+        self.per_interval = config.get("per_interval", 5)
+        interval = config.get("interval", 1) * 60
+
+        if self.awarder is not None and interval != self.interval:
+            self.interval = interval
+            self.stop()
+            self.start()
+        self.interval = interval
+
+    def start(self):
+        """Start awarding points every interval."""
+
+        if self.awarder is None:
+            self.awarder = PeriodicCallback(self.award, self.interval * 1000)
+            self.awarder.start()
+
+    def stop(self):
+        """Stop awarding points."""
+
+        if self.awarder is not None:
+            self.awarder.stop()
+            self.awarder = None
+
+    def join(self, id):
+        """Record that a viewer joined the channel."""
+        self.present.add(id)
+
+    def leave(self, id):
+        """Record that a viewer left the channel."""
+        self.present.discard(id)
+
+    def seen(self, id):
+        """Record chat activity from a viewer, who must be present."""
+        self.present.add(id)
+
+    def award(self):
+        """Award points to every present viewer."""
+
+        if not (self.enabled and self.per_interval and self.present):
+            return
+
+        started = monotonic()
+        amount = self.per_interval
+        ids = list(self.present)
+
+        # Write pending users first, so every viewer has a row to update.
+        self.users.flush()
+
+        cached = self.users.users
+        for id in ids:
+            user = cached.get(id)
+            if user is not None:
+                user.points += amount
+        if self.users.leaderboard is not None:
+            self.users.leaderboard.add(ids, "points", amount)
+
+        parameters = [{"user_id": id, "amount": amount} for id in ids]
+
+        self.awards += 1
+        self.awarded += len(ids)
+
+        if self.writer is None:
+            session = self.users.session
+            try:
+                self._award(session, parameters)
+                session.commit()
+            except Exception:
+                session.rollback()
+                self.logger.exception(
+                    "Failed to award points to %d viewers.", len(ids))
+                raise
+            self._awarded(started, len(ids))
+            return None
+
+        future = self.writer.run(self._award, parameters)
+        IOLoop.current().add_future(
+            future, partial(self._awarded, started, len(ids)))
+        return future
+
+    def _award(self, session, parameters):
+        session.execute(self.award_statement, parameters)
+
+    def _awarded(self, started, count, future=None):
+        if future is not None and future.exception() is not None:
+            self.logger.error(
+                "Failed to award points to %d viewers.", count,
+                exc_info=future.exception())
+            return
+
+        database_flushes.observe(monotonic() - started, "points")
+        self.logger.debug("Awarded points to %d viewers.", count)
+
+    def stats(self):
+        """Get the present viewer count and award totals."""
+
+        return {
+            "present": len(self.present),
+            "awards": self.awards,
+            "awarded": self.awarded
+        }
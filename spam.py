@@ -0,0 +1,85 @@
+from collections import Counter
+from re import compile
+from time import perf_counter
+
+link_expression = compile(
+    "http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|"
+    "[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+")
+
+
+class SpamFilter:
+    """Single-pass spam protection rules."""
+
+    responses = {
+        "length": "Please stop spamming.",
+        "capitals": "Please stop speaking in all caps.",
+        "emotes": "Please stop spamming emoticons.",
+        "links": "Please stop posting links."
+    }
+
+    def __init__(self, config=None):
+        self.hits = Counter()
+        self.evaluations = 0
+        self.evaluation_time = 0.0
+
+        self.configure(config or dict())
+
+    def configure(self, config):
+        """Compile rules from the spam protection configuration."""
+
+        self.maximum_length = config.get("maximum_message_length", 256)
+        self.maximum_capitals = config.get("maximum_message_capitals", 32)
+        self.maximum_emotes = config.get("maximum_message_emotes", 8)
+        self.allow_links = config.get("allow_links", False)
+
+    def check(self, chunks):
+        """Find the first rule broken by a message, if any."""
+
+        started = perf_counter()
+        violation = self._check(chunks)
+        self.evaluations += 1
+        self.evaluation_time += perf_counter() - started
+
+        if violation is not None:
+            self.hits[violation] += 1
+        return violation
+
+    def _check(self, chunks):
+        search_links = None if self.allow_links else link_expression.search
+
+        length = capitals = emotes = 0
+
+        for chunk in chunks:
+            if chunk["type"] == "text":
+                text = chunk["data"]
+            else:
+                text = chunk["text"]
+
+                if chunk["type"] == "emoticon":
+                    emotes += 1
+                    if emotes > self.maximum_emotes:
+                        return "emotes"
+                elif chunk["type"] == "link" and search_links is not None:
+                    return "links"
+
+            length += len(text)
+            if length > self.maximum_length:
+                return "length"
+
+            capitals += sum(map(str.isupper, text))
+            if capitals > self.maximum_capitals:
+                return "capitals"
+
+            if search_links is not None and search_links(text):
+                return "links"
+
+        return None
+
+    def stats(self):
+        """Get rule hit counts and evaluation time."""
+
+        return {
+            "hits": dict(self.hits),
+            "evaluations": self.evaluations,
+            "evaluation_time": self.evaluation_time
+        }
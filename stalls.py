@@ -0,0 +1,137 @@
+from tornado.ioloop import PeriodicCallback
+
+from logging import getLogger as get_logger
+
+from collections import Counter
+from os.path import basename
+from threading import Event, Lock, Thread, get_ident
+from time import monotonic
+from traceback import extract_stack
+import sys
+
+
+class StallDetector:
+    """Detect IOLoop stalls and sample the stacks of blocking callbacks.
+
+    The IOLoop updates a heartbeat every interval. A background thread
+    watches the heartbeat and, while it is late by more than threshold
+    seconds, samples the stack of the IOLoop thread.
+    """
+
+    depth = 6
+
+    def __init__(self, threshold=0.5, interval=0.1, report_interval=300):
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+
+        self.logger = get_logger("CactusBot")
+
+        self.heartbeat = monotonic()
+        self.loop_thread = None
+        self.stopped = Event()
+
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+        self.samples = Counter()
+        self.recent_samples = Counter()
+        self.lock = Lock()
+
+        self.timers = list()
+        self.thread = None
+
+    def start(self):
+        """Start watching the current thread's IOLoop."""
+
+        if self.thread is not None:
+            return
+
+        self.loop_thread = get_ident()
+        self.heartbeat = monotonic()
+
+        self.timers = [
+            PeriodicCallback(self._beat, self.interval * 1000),
+            PeriodicCallback(self.report, self.report_interval * 1000)
+        ]
+        for timer in self.timers:
+            timer.start()
+
+        self.thread = Thread(
+            target=self._watch, name="CactusBot stall detector")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop watching the IOLoop."""
+
+        for timer in self.timers:
+            timer.stop()
+        self.stopped.set()
+        self.thread = None
+
+    def _beat(self):
+        now = monotonic()
+        self.lag = max(0.0, now - self.heartbeat - self.interval)
+        self.heartbeat = now
+
+        self.max_lag = max(self.max_lag, self.lag)
+        if self.lag > self.threshold:
+            self.stalls += 1
+            self.stall_time += self.lag
+            self.logger.warning("IOLoop was blocked for {:.2f}s.".format(
+                self.lag))
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            if monotonic() - self.heartbeat > self.threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    stack = self._signature(frame)
+                    with self.lock:
+                        self.samples[stack] += 1
+                        self.recent_samples[stack] += 1
+
+    def _signature(self, frame):
+        """Summarize the innermost frames of a stack."""
+
+        return " <- ".join(
+            "{}:{} {}".format(
+                basename(entry[0]), entry[1], entry[2])
+            for entry in reversed(extract_stack(frame)[-self.depth:])
+        )
+
+    def top(self, count=5, samples=None):
+        """Get the stacks sampled most often while the IOLoop was blocked."""
+
+        with self.lock:
+            top = (samples or self.samples).most_common(count)
+        return [(stack, hits * self.interval) for stack, hits in top]
+
+    def report(self):
+        """Log the top blockers since the last report."""
+
+        if not self.recent_samples:
+            return
+
+        top = self.top(samples=self.recent_samples)
+        with self.lock:
+            self.recent_samples.clear()
+
+        self.logger.warning("Top IOLoop blockers:")
+        for stack, seconds in top:
+            self.logger.warning("  {:.1f}s in {}".format(seconds, stack))
+
+    def stats(self):
+        """Get stall counters."""
+
+        return {
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+            "stalls": self.stalls,
+            "stall_time": self.stall_time,
+            "samples": sum(self.samples.values()),
+            "top": self.top()
+        }
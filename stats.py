@@ -0,0 +1,210 @@
+from codec import loads, dumps
+
+from tornado.ioloop import PeriodicCallback
+
+from logging import getLogger as get_logger
+from collections import Counter, OrderedDict
+from itertools import islice
+from os import replace
+from os.path import exists
+from time import time
+
+
+class Statistics:
+    """Per-stream counters, persisted as append-only snapshots.
+
+    Counters of the current stream are aggregated in memory, and snapshots
+    of them are appended to a JSON lines file periodically, so earlier
+    streams are never rewritten. When the file is loaded, the last snapshot
+    of each stream wins, and the file is compacted once it holds many
+    superseded snapshots.
+
+    Past streams are kept in memory, in order, along with running totals,
+    so queries never read the file.
+    """
+
+    counters = (
+        "messages", "commands", "follows", "subscriptions", "spam_removals"
+    )
+
+    def __init__(self, filename=None, config=None):
+        self.filename = filename
+
+        self.logger = get_logger("CactusBot")
+
+        self.streams = OrderedDict()
+        self.current = None
+        self.changed = False
+
+        self.totals = Counter()
+        self.peak_viewers = 0
+
+        self.lines = 0
+        self.snapshots = 0
+        self.snapshotter = None
+
+        self.configure(config or dict())
+
+    def configure(self, config):
+        """Apply the statistics configuration."""
+
+        self.interval = config.get("snapshot_interval", 60)
+        self.compact_ratio = config.get("compact_ratio", 4)
+
+    def load(self, filename):
+        """Load past streams from a snapshot file."""
+
+        self.filename = filename
+        self.streams.clear()
+        self.current = None
+        self.lines = 0
+        malformed = False
+
+        if exists(filename):
+            with open(filename) as snapshots:
+                for line in snapshots:
+                    self.lines += 1
+                    try:
+                        stream = loads(line)
+                    except ValueError:
+                        malformed = True
+                        continue
+                    self.streams[stream["stream"]] = stream
+
+        for stream in self.streams.values():
+            if stream["ended"] is None:
+                self.current = stream
+
+        self._total()
+
+        if malformed:
+            self.logger.warning("Skipped malformed statistics snapshots.")
+        if malformed or (
+                self.lines > self.compact_ratio * max(len(self.streams), 1)):
+            self.compact()
+
+        self.logger.info("Loaded statistics of {} streams.".format(
+            len(self.streams)))
+        return self.streams
+
+    def _total(self):
+        self.totals = Counter()
+        self.peak_viewers = 0
+        for stream in self.streams.values():
+            if stream is not self.current:
+                self._add_to_totals(stream)
+
+    def _add_to_totals(self, stream):
+        for counter in self.counters:
+            self.totals[counter] += stream[counter]
+        self.peak_viewers = max(self.peak_viewers, stream["peak_viewers"])
+
+    def compact(self):
+        """Rewrite the snapshot file with one snapshot per stream."""
+
+        temporary = self.filename + ".tmp"
+        with open(temporary, 'w') as snapshots:
+            for stream in self.streams.values():
+                snapshots.write(dumps(stream) + '\n')
+        replace(temporary, self.filename)
+
+        self.logger.debug("Compacted statistics from %d to %d snapshots.",
+                          self.lines, len(self.streams))
+        self.lines = len(self.streams)
+
+    def start(self):
+        """Start writing snapshots periodically."""
+
+        if self.snapshotter is None:
+            self.snapshotter = PeriodicCallback(
+                self.snapshot, self.interval * 1000)
+            self.snapshotter.start()
+
+    def stop(self):
+        """Stop writing snapshots periodically, and write a last one."""
+
+        if self.snapshotter is not None:
+            self.snapshotter.stop()
+            self.snapshotter = None
+        self.snapshot()
+
+    def begin(self, stream):
+        """Start counting a stream, identified by when it went live."""
+
+        if self.current is not None:
+            if self.current["stream"] == stream:
+                return
+            # The end of the last stream was missed; it ended by its last
+            # snapshot.
+            self.end(self.current["updated"])
+
+        self.current = dict(
+            {counter: 0 for counter in self.counters},
+            stream=stream, started=time(), ended=None, updated=time(),
+            peak_viewers=0)
+        self.streams[stream] = self.current
+        self.changed = True
+
+    def end(self, at=None):
+        """Stop counting the current stream."""
+
+        if self.current is None:
+            return
+
+        self.current["ended"] = at or time()
+        self.changed = True
+        self.snapshot()
+
+        self._add_to_totals(self.current)
+        self.current = None
+
+    def record(self, counter, amount=1):
+        """Add to a counter of the current stream."""
+
+        if self.current is not None:
+            self.current[counter] += amount
+            self.changed = True
+
+    def viewers(self, count):
+        """Record the current viewer count of the stream."""
+
+        if self.current is not None and count > self.current["peak_viewers"]:
+            self.current["peak_viewers"] = count
+            self.changed = True
+
+    def snapshot(self):
+        """Append the current stream's counters to the snapshot file."""
+
+        if not (self.changed and self.filename and self.current):
+            return
+
+        self.current["updated"] = time()
+        with open(self.filename, 'a') as snapshots:
+            snapshots.write(dumps(self.current) + '\n')
+
+        self.changed = False
+        self.lines += 1
+        self.snapshots += 1
+
+    def recent(self, count=5):
+        """Get the most recent streams, newest first."""
+
+        return [
+            self.streams[stream]
+            for stream in islice(reversed(self.streams), count)
+        ]
+
+    def summary(self):
+        """Get totals over every stream, including the current one."""
+
+        summary = {
+            counter: self.totals[counter] for counter in self.counters}
+        summary["streams"] = len(self.streams)
+        summary["peak_viewers"] = self.peak_viewers
+
+        if self.current is not None:
+            for counter in self.counters:
+                summary[counter] += self.current[counter]
+            summary["peak_viewers"] = max(
+                summary["peak_viewers"], self.current["peak_viewers"])
+        return summary
@@ -0,0 +1,378 @@
+# Spread CactusBot channels across worker processes.
+#
+# Each worker runs a MultiChannel runtime for some of the channels in the
+# configuration file's "channels" object. Workers send their logs, metrics
+# and per-channel event counts to the supervisor, which restarts crashed
+# workers and moves channels from busy workers to idle ones.
+
+from multichannel import MultiChannel
+from beam import Beam
+import metrics
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from logging import getLogger as get_logger
+from logging.handlers import QueueHandler, QueueListener
+
+from multiprocessing import get_context, cpu_count
+from queue import Empty
+
+from json import load
+from time import monotonic
+
+from argparse import ArgumentParser
+
+
+def run_worker(index, config_file, channels, commands, reports, logs,
+               options, report_interval=5):
+    """Run a worker process's channels, reporting to the supervisor."""
+
+    logger = get_logger("CactusBot")
+    logger.propagate = False
+    logger.setLevel("DEBUG")
+
+    handler = QueueHandler(logs)
+    if str(options.get("debug")).lower() not in ("true", "debug"):
+        handler.setLevel("INFO")
+    logger.addHandler(handler)
+
+    get_logger("tornado").setLevel("WARNING")
+
+    runtime = MultiChannel(
+        config_file, logger=logger, serve_metrics=False, **options)
+    runtime._init_http_client()
+
+    def receive():
+        while True:
+            try:
+                command, name = commands.get_nowait()
+            except Empty:
+                return
+            if command == "add" and name not in runtime.channels:
+                runtime.add_channel(name)
+            elif command == "remove":
+                if name in runtime.channels:
+                    runtime.remove_channel(name)
+                reports.put(("removed", index, name))
+            elif command == "stop":
+                runtime.stop("CactusBot deactivated! :cactus")
+                IOLoop.current().stop()
+                return
+
+    def report():
+        reports.put((
+            "report",
+            index,
+            {name: bot.handled for name, bot in runtime.channels.items()},
+            metrics.default_registry.snapshot()
+        ))
+
+    PeriodicCallback(receive, 1000).start()
+    PeriodicCallback(report, report_interval * 1000).start()
+
+    runtime.run(channels)
+
+
+class Worker:
+    """Supervisor's record of a worker process."""
+
+    def __init__(self, index, channels):
+        self.index = index
+        self.channels = set(channels)
+
+        self.process = None
+        self.commands = None
+        self.started = None
+
+        self.restarts = 0
+        self.restarting = False
+
+
+class Supervisor(Beam):
+    """Run channels in worker processes, one per CPU core by default."""
+
+    rate_smoothing = 0.3
+    tolerance = 0.25
+
+    def __init__(self, config_file="data/config.json", workers=None,
+                 debug="info", **kwargs):
+        super(Supervisor, self).__init__(debug, **kwargs)
+
+        self.config_file = config_file
+        self.worker_count = workers or cpu_count()
+        self.rebalance_interval = kwargs.get("rebalance_interval", 300)
+
+        self.options = {
+            "debug": debug,
+            "silent": kwargs.get("silent", False),
+            "api": kwargs.get("api"),
+            "liveloading": kwargs.get("liveloading")
+        }
+
+        self.context = get_context("spawn")
+        self.reports = self.context.Queue()
+        self.logs = self.context.Queue()
+
+        self.workers = list()
+        self.counts = dict()
+        self.rates = dict()
+        self.snapshots = dict()
+        self.moving = dict()
+
+    def load_config(self, filename):
+        """Load configuration file."""
+
+        with open(filename) as config:
+            self.config = load(config)
+
+        if not self.config.get("channels"):
+            raise KeyError("No channels are configured.")
+
+        return self.config
+
+    def start_worker(self, worker):
+        """Start, or restart, a worker process."""
+
+        worker.restarting = False
+        worker.commands = self.context.Queue()
+        worker.process = self.context.Process(
+            target=run_worker,
+            name="cactusbot-worker-{}".format(worker.index),
+            args=(worker.index, self.config_file, sorted(worker.channels),
+                  worker.commands, self.reports, self.logs, self.options)
+        )
+        worker.process.start()
+        worker.started = monotonic()
+
+        self.logger.info("Started worker {} (pid {}) for {}.".format(
+            worker.index, worker.process.pid,
+            ', '.join(sorted(worker.channels)) or "no channels"))
+
+    def supervise(self):
+        """Collect reports, and restart workers that have exited."""
+
+        while True:
+            try:
+                report = self.reports.get_nowait()
+            except Empty:
+                break
+            if report[0] == "removed":
+                self._moved(report[2])
+            else:
+                index, counts, snapshot = report[1:]
+                self.snapshots[index] = snapshot
+                self._update_rates(counts)
+
+        for worker in self.workers:
+            if worker.restarting or worker.process.is_alive():
+                continue
+
+            self.snapshots.pop(worker.index, None)
+
+            # A dead worker no longer runs the channels it was moving.
+            for name, (source, destination) in list(self.moving.items()):
+                if source is worker:
+                    self._moved(name)
+
+            if monotonic() - worker.started > 60:
+                worker.restarts = 0
+            delay = min(60, 2 ** worker.restarts)
+            worker.restarts += 1
+            worker.restarting = True
+
+            self.logger.error(
+                "Worker {} exited with code {}. Restarting in {} "
+                "seconds...".format(
+                    worker.index, worker.process.exitcode, delay))
+            IOLoop.current().call_later(delay, self.start_worker, worker)
+
+    def _update_rates(self, counts):
+        now = monotonic()
+        for name, count in counts.items():
+            last_count, last_time = self.counts.get(name, (0, now))
+            self.counts[name] = (count, now)
+
+            if count < last_count:
+                last_count = 0
+            if now <= last_time:
+                continue
+
+            rate = (count - last_count) / (now - last_time)
+            self.rates[name] = (
+                self.rate_smoothing * rate +
+                (1 - self.rate_smoothing) * self.rates.get(name, rate)
+            )
+
+    def load(self, worker):
+        """Get the total event rate of a worker's channels."""
+        return sum(self.rates.get(name, 0) for name in worker.channels)
+
+    def rebalance(self):
+        """Move channels from the busiest workers to the least busy."""
+
+        if len(self.workers) < 2:
+            return
+
+        mean = sum(map(self.load, self.workers)) / len(self.workers)
+        if not mean:
+            return
+
+        for _ in range(len(self.config["channels"])):
+            busiest = max(self.workers, key=self.load)
+            idlest = min(self.workers, key=self.load)
+
+            if self.load(busiest) <= mean * (1 + self.tolerance):
+                break
+
+            gap = self.load(busiest) - self.load(idlest)
+            candidates = [
+                name for name in busiest.channels
+                if 0 < self.rates.get(name, 0) < gap
+            ]
+            if not candidates:
+                break
+
+            name = max(candidates, key=lambda name: self.rates[name])
+            self.move(name, busiest, idlest)
+
+    def move(self, name, source, destination):
+        """Move a channel from one worker to another.
+
+        The destination only adds the channel once the source has removed
+        it, so the two never run it, or write its files, at the same time.
+        """
+
+        self.logger.info(
+            "Moving {} ({:.1f} events/sec) from worker {} to worker "
+            "{}.".format(name, self.rates.get(name, 0), source.index,
+                         destination.index))
+
+        source.channels.discard(name)
+        self.moving[name] = (source, destination)
+        source.commands.put(("remove", name))
+
+    def _moved(self, name):
+        """Add a channel to its destination, after its source removed it."""
+
+        if name not in self.moving:
+            return
+        source, destination = self.moving.pop(name)
+
+        destination.channels.add(name)
+        destination.commands.put(("add", name))
+
+    def _collect_metrics(self):
+        metrics.default_registry.combine(self.snapshots.values())
+        for name, rate in self.rates.items():
+            metrics.channel_rate.set(rate, name)
+        for worker in self.workers:
+            metrics.worker_restarts.set(worker.restarts, worker.index)
+
+    def stop(self, timeout=10):
+        """Wait for workers to exit, terminating any that do not."""
+
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.commands.put(("stop", None))
+
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+    def run(self):
+        """Start workers and supervise them."""
+
+        self.load_config(self.config_file)
+
+        channels = sorted(self.config["channels"])
+        self.workers = [
+            Worker(index, channels[index::self.worker_count])
+            for index in range(min(self.worker_count, len(channels)))
+        ]
+
+        listener = QueueListener(
+            self.logs, *self.logger.handlers, respect_handler_level=True)
+        listener.start()
+
+        metrics.default_registry.add_collector(self._collect_metrics)
+        metrics_config = self.config.get("metrics", dict())
+        if metrics_config.get("enabled", False):
+            metrics.start_server(
+                metrics_config.get("port", 9100),
+                metrics_config.get("address", ''))
+
+        for worker in self.workers:
+            self.start_worker(worker)
+
+        PeriodicCallback(self.supervise, 1000).start()
+        PeriodicCallback(
+            self.rebalance, self.rebalance_interval * 1000).start()
+
+        try:
+            IOLoop.current().start()
+        except KeyboardInterrupt:
+            print()
+            self.logger.info("Waiting for workers to exit...")
+            self.stop()
+        finally:
+            listener.stop()
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(
+        description="Run CactusBot channels in several worker processes.")
+
+    parser.add_argument(
+        "--config",
+        help="configuration file with a \"channels\" object",
+        dest="config_file",
+        default="data/config.json"
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="number of worker processes (default: one per CPU core)",
+        type=int,
+        default=None
+    )
+
+    parser.add_argument(
+        "--rebalance-interval",
+        help="seconds between rebalancing channels across workers",
+        type=int,
+        default=300
+    )
+
+    parser.add_argument(
+        "--silent",
+        help="send no messages to chat",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--debug",
+        help="set custom logger level",
+        nargs='?',
+        const=True,
+        default="info"
+    )
+
+    parser.add_argument(
+        "--api",
+        help="use a custom Beam API URL",
+        default=None
+    )
+
+    parser.add_argument(
+        "--liveloading",
+        help="use a custom Beam liveloading websocket URL",
+        default=None
+    )
+
+    parsed = parser.parse_args()
+
+    Supervisor(**parsed.__dict__).run()
@@ -0,0 +1,315 @@
+from models import User
+from metrics import database_flushes, presence_events
+
+from sqlalchemy import bindparam, text
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from logging import getLogger as get_logger
+from collections import OrderedDict
+from functools import partial
+from time import monotonic
+
+
+class CachedUser:
+    """In-memory copy of a user with unflushed counter increments."""
+
+    __slots__ = (
+        "id", "friend", "joins", "messages", "offenses", "points",
+        "new", "changes"
+    )
+
+    def __init__(self, id, friend=False, joins=0, messages=0, offenses=0,
+                 points=0, new=False):
+        self.id = id
+        self.friend = friend
+        self.joins = joins
+        self.messages = messages
+        self.offenses = offenses
+        self.points = points
+        self.new = new
+        self.changes = dict()
+
+
+class UserStore:
+    """Write-behind cache of users.
+
+    Counter increments are applied in memory and written to the database
+    in one transaction, either periodically or once enough users have
+    changed. Given a DatabaseWriter, transactions run on its thread.
+
+    At most capacity users are kept; the least recently used users without
+    pending changes are forgotten first.
+
+    Joins and leaves are merged per user between flushes, so a user who
+    reconnects is only counted once. Joins of users who are not cached are
+    buffered without loading them, and written with a single upsert.
+    """
+
+    counters = ("joins", "messages", "offenses")
+
+    def __init__(self, session, interval=5, threshold=500, capacity=10000,
+                 writer=None, join_capacity=5000, leaderboard=None):
+        self.session = session
+        self.writer = writer
+        self.leaderboard = leaderboard
+        self.interval = interval
+        self.threshold = threshold
+        self.capacity = capacity
+        self.join_capacity = join_capacity
+
+        self.logger = get_logger("CactusBot")
+
+        self.users = OrderedDict()
+        self.dirty = set()
+        self.writing = set()
+        self.evictions = 0
+
+        self.present = dict()
+        self.joined = dict()
+        self.joining = dict()
+
+        self.flusher = None
+        self.flushes = 0
+        self.flush_time = 0.0
+
+        table = User.__table__
+        self.insert_statement = text(
+            "INSERT INTO {table} (id, friend, joins, messages, offenses, "
+            "points) VALUES (:id, :friend, :joins, :messages, :offenses, "
+            ":points) ON CONFLICT (id) DO UPDATE SET {counters}".format(
+                table=table.name,
+                counters=", ".join(
+                    "{0} = {1}.{0} + excluded.{0}".format(column, table.name)
+                    for column in self.counters + ("points",))))
+        self.update_statement = table.update().where(
+            table.c.id == bindparam("user_id")
+        ).values(
+            friend=bindparam("friend_value"),
+            **{
+                counter: table.c[counter] + bindparam(counter + "_delta")
+                for counter in self.counters
+            }
+        )
+
+    def __len__(self):
+        return len(self.users)
+
+    def start(self):
+        """Start flushing changes periodically."""
+
+        if self.flusher is None:
+            self.flusher = PeriodicCallback(self.flush, self.interval * 1000)
+            self.flusher.start()
+
+    def stop(self):
+        """Stop flushing periodically, and write remaining changes."""
+
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher = None
+
+        future = self.flush()
+        if future is not None:
+            future.result()
+
+    def get(self, id, create=True):
+        """Get a user, loading it from the database if it is not cached."""
+
+        user = self.users.get(id)
+        if user is not None:
+            self.users.move_to_end(id)
+            return user
+
+        # A primary key lookup is read on the loop, on its own connection,
+        # so the session never holds a read transaction open across writes.
+        table = User.__table__
+        with self.session.bind.connect() as connection:
+            row = connection.execute(
+                table.select().where(table.c.id == id)).first()
+
+        if row is not None:
+            user = CachedUser(
+                row.id, bool(row.friend), row.joins or 0, row.messages or 0,
+                row.offenses or 0, row.points or 0)
+        elif id in self.joining:
+            # The row is being inserted with the buffered joins; it exists
+            # as far as later changes are concerned.
+            user = CachedUser(id, joins=self.joining[id])
+        elif create:
+            user = CachedUser(id, new=True)
+            self.dirty.add(id)
+        else:
+            return None
+
+        self.users[id] = user
+
+        joins = self.joined.pop(id, 0)
+        if joins:
+            self.increment(user, "joins", joins)
+
+        if len(self.users) > self.capacity:
+            self._evict()
+        return user
+
+    def _evict(self):
+        """Forget the least recently used users without pending changes."""
+
+        excess = len(self.users) - self.capacity
+        evicted = list()
+        for id in self.users:
+            if len(evicted) >= excess:
+                break
+            if id not in self.dirty and id not in self.writing:
+                evicted.append(id)
+
+        for id in evicted:
+            del self.users[id]
+        self.evictions += len(evicted)
+
+    def join(self, id):
+        """Record that a user joined the channel."""
+
+        if id in self.present:
+            self.present[id] = True
+            presence_events.inc("merged")
+            return
+
+        self.present[id] = True
+
+        user = self.users.get(id)
+        if user is not None:
+            self.increment(user, "joins")
+        else:
+            self.joined[id] = self.joined.get(id, 0) + 1
+            if len(self.present) >= self.join_capacity:
+                self.flush()
+        presence_events.inc("join")
+
+    def leave(self, id):
+        """Record that a user left the channel."""
+
+        self.present[id] = False
+        presence_events.inc("leave")
+        if len(self.present) >= self.join_capacity:
+            self.flush()
+
+    def increment(self, user, counter, amount=1):
+        """Increment a user's counter."""
+
+        value = getattr(user, counter) + amount
+        setattr(user, counter, value)
+        user.changes[counter] = user.changes.get(counter, 0) + amount
+        if self.leaderboard is not None and counter == "messages":
+            self.leaderboard.update(user.id, counter, value)
+        self._mark(user)
+
+    def set_friend(self, user, friend):
+        """Set whether a user is a friend."""
+
+        user.friend = friend
+        self._mark(user)
+
+    def _mark(self, user):
+        if user.id not in self.users:
+            self.users[user.id] = user
+        self.dirty.add(user.id)
+        if len(self.dirty) >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        """Write all pending changes in a single transaction."""
+
+        self.present.clear()
+
+        if not (self.dirty or self.joined):
+            return
+
+        started = monotonic()
+
+        joined = [
+            {
+                "id": id, "friend": False, "joins": joins, "messages": 0,
+                "offenses": 0, "points": 0
+            } for id, joins in self.joined.items()
+        ]
+        inserts = list(joined)
+        updates = list()
+        self.joined.clear()
+
+        for id in self.dirty:
+            user = self.users[id]
+            if user.new:
+                inserts.append({
+                    "id": user.id,
+                    "friend": user.friend,
+                    "joins": user.joins,
+                    "messages": user.messages,
+                    "offenses": user.offenses,
+                    "points": user.points
+                })
+                user.new = False
+            else:
+                update = {"user_id": user.id, "friend_value": user.friend}
+                for counter in self.counters:
+                    update[counter + "_delta"] = user.changes.get(counter, 0)
+                updates.append(update)
+            user.changes = dict()
+
+        self.dirty.clear()
+
+        if self.writer is None:
+            try:
+                self._write(self.session, inserts, updates)
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                self.logger.exception("Failed to flush {} users.".format(
+                    len(inserts) + len(updates)))
+                raise
+            self._flushed(started, len(inserts) + len(updates))
+            return None
+
+        ids = [row["id"] for row in inserts] + [
+            row["user_id"] for row in updates]
+        self.writing.update(ids)
+
+        joining = [(row["id"], row["joins"]) for row in joined]
+        for id, joins in joining:
+            self.joining[id] = self.joining.get(id, 0) + joins
+
+        future = self.writer.run(self._write, inserts, updates)
+        IOLoop.current().add_future(
+            future, partial(self._written, ids, joining, started))
+        return future
+
+    def _write(self, session, inserts, updates):
+        if inserts:
+            session.execute(self.insert_statement, inserts)
+        if updates:
+            session.execute(self.update_statement, updates)
+
+    def _written(self, ids, joining, started, future):
+        self.writing.difference_update(ids)
+        for id, joins in joining:
+            self.joining[id] -= joins
+            if not self.joining[id]:
+                del self.joining[id]
+
+        if future.exception() is not None:
+            self.logger.error(
+                "Failed to flush %d users.", len(ids),
+                exc_info=future.exception())
+            return
+
+        self._flushed(started, len(ids))
+
+    def _flushed(self, started, count):
+        if len(self.users) > self.capacity:
+            self._evict()
+
+        elapsed = monotonic() - started
+        self.flushes += 1
+        self.flush_time += elapsed
+        database_flushes.observe(elapsed, "users")
+        self.logger.debug("Flushed %d users.", count)